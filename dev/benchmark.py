@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the nanorod pipeline on synthetic TEM-like micrographs.
+
+Each stage of the pipeline is timed separately on images of several sizes and densities of nanorods, and its peak memory is measured
+in a second run, so that tracing the memory doesn't slow down the timed run. The Pythagorean lengths are checked against the known
+lengths of the synthetic nanorods. The import time of the Python modules is measured too. The results are written as JSON lines, one record per (image, stage), so that they can be compared across versions.
+
+Usage: python dev/benchmark.py --sizes 1024 4096 8192 --densities 2 8 --output benchmark.jsonl
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tracemalloc
+import numpy as np
+from scipy import ndimage as ndi
+from skimage import draw, measure
+
+PYTHON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'inst', 'python')
+sys.path.insert(0, PYTHON_DIR)
+import electron_microscopy as em  # noqa: E402
+
+# Python modules of the package whose import time is measured, since it adds to the start of every session and worker.
+IMPORTED_MODULES = ['electron_microscopy', 'Electron_microscopy_Pythagoras_mrc_multi', 'nanorod_service']
+
+# Width of the synthetic nanorods in nm. It is the width assumed by create_length_prop, so their Pythagorean length is their true length.
+ROD_WIDTH_IN_NM = 18
+
+
+def synthetic_micrograph(size, n_rods, pixel_size=0.5, min_length=60, max_length=200, seed=0):
+    """This function makes a synthetic TEM-like image of "size" x "size" pixels with up to "n_rods" bright, non-overlapping nanorods of
+    random orientation and of lengths between "min_length" and "max_length" nm, on a noisy background with a slow gradient.
+    The output is the image (float32) and the list of (centre row, centre column, length in nm) of the nanorods that were placed."""
+    rng = np.random.default_rng(seed)
+    img = np.zeros((size, size), dtype=np.float32)
+    occupied = np.zeros((size, size), dtype=bool)
+    rods = []
+    margin = int(max_length / pixel_size) // 2 + 20  # Keeps the nanorods away from the border, which clear_border would remove.
+    gap = 12  # Minimum distance in pixels between two nanorods, so that the dilations in img_prep don't merge them.
+    for _ in range(n_rods * 20):
+        if len(rods) == n_rods or margin * 2 >= size:
+            break
+        length = rng.uniform(min_length, max_length)
+        row, col = rng.uniform(margin, size - margin, 2)
+        angle = rng.uniform(0, np.pi)
+        along = np.array([np.sin(angle), np.cos(angle)])
+        across = np.array([np.cos(angle), -np.sin(angle)])
+
+        def corners(half_length, half_width):
+            return np.array([
+                [row, col] + sign_l * half_length * along + sign_w * half_width * across
+                for sign_l, sign_w in ((-1, -1), (1, -1), (1, 1), (-1, 1))
+            ])
+
+        half_length = length / pixel_size / 2
+        half_width = ROD_WIDTH_IN_NM / pixel_size / 2
+        outer = corners(half_length + gap, half_width + gap)
+        rr, cc = draw.polygon(outer[:, 0], outer[:, 1], img.shape)
+        if occupied[rr, cc].any():
+            continue
+        occupied[rr, cc] = True
+        inner = corners(half_length, half_width)
+        rr, cc = draw.polygon(inner[:, 0], inner[:, 1], img.shape)
+        img[rr, cc] = 3
+        rods.append((row, col, length))
+
+    img = ndi.gaussian_filter(img, 1)
+    img += np.linspace(0, 2, size, dtype=np.float32)[np.newaxis, :]  # Uneven illumination, for the adaptive thresholding.
+    img += rng.normal(0, 1, img.shape).astype(np.float32)
+    return img, rods
+
+
+def run_stage(function, *args, **kwargs):
+    """This function runs one stage twice: once timed, and once under tracemalloc for its peak memory in bytes, since tracing every
+    allocation slows down the stage, and not evenly across stages. The stages don't modify their inputs, so both runs do the same work.
+    The output is the output of the timed run, its time in seconds and the peak memory."""
+    start = time.perf_counter()
+    output = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    function(*args, **kwargs)
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return output, seconds, peak_bytes
+
+
+def legacy_lengths(labels, pixel_size):
+    """This function measures the lengths like the original pipeline, through regionprops and create_length_prop."""
+    return [i.length for i in em.create_length_prop(measure.regionprops(labels), pixel_size)]
+
+
+def check_lengths(labels, table, rods, tolerance=0.1):
+    """This function matches each synthetic nanorod with the label at its centre and compares the measured and true lengths.
+    The output is a dictionary with the numbers of nanorods placed and found, the statistics of the relative length errors, and whether
+    every nanorod was found with an error within "tolerance". The dilations in img_prep make the nanorods a few % longer, hence the slack."""
+    lengths = dict(zip(table['label'], table['length']))
+    errors = []
+    found = set()
+    for row, col, length in rods:
+        label = labels[int(round(row)), int(round(col))]
+        if label > 0 and label not in found:
+            found.add(label)
+            errors.append((lengths[label] - length) / length)
+    errors = np.abs(errors)
+    return {
+        'rods': len(rods),
+        'found': len(found),
+        'labels': len(table['label']),
+        'median_relative_error': float(np.median(errors)) if len(errors) > 0 else None,
+        'max_relative_error': float(np.max(errors)) if len(errors) > 0 else None,
+        'passed': bool(len(found) == len(rods) and np.all(errors <= tolerance)),
+    }
+
+
+def benchmark_image(size, density, pixel_size, seed, tolerance=0.1):
+    """This function runs every stage of the pipeline on one synthetic image. The output is a list of records."""
+    n_rods = int(density * size * size / 1e6)  # "density" is in nanorods per megapixel.
+    img, rods = synthetic_micrograph(size, n_rods, pixel_size, seed=seed)
+    stages = []
+
+    binary, seconds, peak = run_stage(em.img_prep, img)
+    stages.append(('img_prep', seconds, peak))
+    labels, seconds, peak = run_stage(em.watershedding, binary)
+    stages.append(('watershedding', seconds, peak))
+    labels, seconds, peak = run_stage(
+        em.filter_labels, labels,
+        [em.area_filter(500, pixel_size), em.minor_axis_length_filter(40, pixel_size)], reorder=True
+    )
+    stages.append(('filter_labels', seconds, peak))
+    table, seconds, peak = run_stage(em.measure_labels, labels, pixel_size)
+    stages.append(('measure_labels', seconds, peak))
+    _, seconds, peak = run_stage(em.measure_labels, labels, pixel_size, fast_feret=True)
+    stages.append(('measure_labels_fast_feret', seconds, peak))
+    legacy, seconds, peak = run_stage(legacy_lengths, labels, pixel_size)
+    stages.append(('create_length_prop', seconds, peak))
+    _, seconds, peak = run_stage(em.preview_images, labels, img)
+    stages.append(('preview_images', seconds, peak))
+
+    image = {'size': size, 'density': density, 'pixel_size': pixel_size, 'seed': seed}
+    records = [dict(image, stage=stage, seconds=seconds, peak_bytes=peak) for stage, seconds, peak in stages]
+    accuracy = check_lengths(labels, table, rods, tolerance)
+    accuracy['legacy_lengths_match'] = bool(np.allclose(legacy, table['length'], equal_nan=True))
+    records.append(dict(image, stage='accuracy', **accuracy))
+    return records
+
+
+def import_records():
+    """This function measures, in a fresh interpreter each time, how long the modules of the package take to import, and how
+    long the libraries of the pipeline then take to load with preload. The output is a list of records."""
+    records = []
+    code = (
+        'import sys, time, json; sys.path.insert(0, sys.argv[1]); start = time.perf_counter(); import {module}; '
+        'seconds = time.perf_counter() - start; start = time.perf_counter(); import electron_microscopy; '
+        'electron_microscopy.preload(plotting=True); print(json.dumps([seconds, time.perf_counter() - start]))'
+    )
+    for module in IMPORTED_MODULES:
+        output = subprocess.run(
+            [sys.executable, '-c', code.format(module=module), PYTHON_DIR], capture_output=True, text=True, check=True
+        ).stdout
+        seconds, preload_seconds = json.loads(output.splitlines()[-1])
+        records.append({'stage': 'import', 'module': module, 'seconds': seconds, 'preload_seconds': preload_seconds})
+    return records
+
+
+def version_info():
+    """This function returns the version of the package and the git commit of the working tree, if there is one."""
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    version = None
+    with open(os.path.join(root, 'DESCRIPTION')) as description:
+        for line in description:
+            if line.startswith('Version:'):
+                version = line.split(':', 1)[1].strip()
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=root, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'version': version, 'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks the nanorod pipeline on synthetic micrographs.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 4096, 8192], help='Sides of the images in pixels.')
+    parser.add_argument('--densities', type=float, nargs='+', default=[2, 8], help='Nanorods per megapixel.')
+    parser.add_argument('--pixel-size', type=float, default=0.5, help='Pixel size in nm (default: 0.5).')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of images per size and density.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Largest relative length error accepted (default: 0.1).')
+    parser.add_argument('--output', default=None, help='JSON lines file to append the results to (default: standard output).')
+    args = parser.parse_args(argv)
+
+    run = dict(version_info(), started=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    output = open(args.output, 'a') if args.output else sys.stdout
+    try:
+        for record in import_records():
+            output.write(json.dumps(dict(run, **record)) + '\n')
+        for size in args.sizes:
+            for density in args.densities:
+                for seed in range(args.repeat):
+                    for record in benchmark_image(size, density, args.pixel_size, seed, args.tolerance):
+                        output.write(json.dumps(dict(run, **record)) + '\n')
+                    output.flush()
+                    print('Benchmarked', size, 'x', size, 'pixels,', density, 'nanorods per megapixel, seed', seed, file=sys.stderr)
+        output.write(json.dumps(dict(run, stage='process', max_rss_bytes=em.peak_rss_bytes())) + '\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,357 @@
+# -*- coding: utf-8 -*-
+"""
+Checks of the parts of the Python pipeline that the Shiny app and the batch script can't exercise on their own.
+
+Each check builds its own fixtures in a temporary folder and raises an AssertionError if something is wrong. All the checks are run
+by default, or only the ones named on the command line.
+
+Usage: python dev/checks.py [dm_loader service_recovery service_access result_store missing_modules segment_tiled filter_labels watershedding_components ...]
+"""
+
+import os
+import sys
+import time
+import signal
+import stat
+import struct
+import tempfile
+import traceback
+import subprocess
+import numpy as np
+
+PYTHON_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'inst', 'python')
+sys.path.insert(0, PYTHON_DIR)
+import electron_microscopy as em  # noqa: E402
+import nanorod_service  # noqa: E402
+from benchmark import synthetic_micrograph  # noqa: E402
+
+
+def dm4_tag_group(entries):
+    """This function encodes a DM4 tag group: a list of (label, value) pairs where a value is either bytes (an encoded tag, see
+    dm4_tag) or a nested list of entries. An empty label makes an unlabelled tag, as used for the items of the DM lists."""
+    data = struct.pack('>BBQ', 0, 0, len(entries))
+    for label, value in entries:
+        label = label.encode()
+        if isinstance(value, list):
+            group = dm4_tag_group(value)
+            data += struct.pack('>BH', 20, len(label)) + label + struct.pack('>Q', len(group)) + group
+        else:
+            data += struct.pack('>BH', 21, len(label)) + label + struct.pack('>Q', len(value)) + value
+    return data
+
+
+def dm4_tag(encoded_type, payload, array_size=None):
+    """This function encodes the body of a DM4 tag: a single value of "encoded_type", or an array of "array_size" of them."""
+    if array_size is None:
+        return b'%%%%' + struct.pack('>QQ', 1, encoded_type) + payload
+    return b'%%%%' + struct.pack('>QQQQ', 3, 20, encoded_type, array_size) + payload
+
+
+def write_dm4(path, img, pixel_size, unit='nm'):
+    """This function writes a 2D float32 image as a minimal DM4 file, with the tags ncempy needs to read it: the calibration of each
+    dimension (origin, scale and unit), the pixel data, their type and the dimensions. There is no thumbnail."""
+    img = np.ascontiguousarray(img, dtype='<f4')
+    units = np.frombuffer(unit.encode('utf-16-le'), dtype='<u2')
+    dimension = [
+        ('Origin', dm4_tag(6, struct.pack('<f', 0))),
+        ('Scale', dm4_tag(6, struct.pack('<f', pixel_size))),
+        ('Units', dm4_tag(4, units.tobytes(), len(units))),
+    ]
+    image_data = [
+        ('Calibrations', [('Dimension', [('', dimension), ('', dimension)])]),
+        ('Data', dm4_tag(6, img.tobytes(), img.size)),
+        ('DataType', dm4_tag(3, struct.pack('<i', 2))),  # 2 is float32.
+        ('Dimensions', [('', dm4_tag(5, struct.pack('<I', img.shape[1]))), ('', dm4_tag(5, struct.pack('<I', img.shape[0])))]),
+    ]
+    root = dm4_tag_group([('ImageList', [('', [('ImageData', image_data)])])])
+    with open(path, 'wb') as dm4_file:
+        dm4_file.write(struct.pack('>IQI', 4, 16 + len(root), 1) + root)
+
+
+def check_dm_loader(folder):
+    """This function checks that the DM4 images are read correctly, that read_header doesn't read their pixels, and that open_image
+    memory-maps them."""
+    from ncempy.io import dm
+    rng = np.random.default_rng(0)
+    img = rng.normal(0, 1, (300, 200)).astype(np.float32)
+    path = os.path.join(folder, 'fixture.dm4')
+    write_dm4(path, img, 0.25)
+
+    filename, loaded, pixel_size = em.open_DM4(path)
+    assert np.array_equal(loaded, img) and abs(pixel_size - 0.25) < 1e-6, 'open_DM4 does not read the fixture back'
+
+    # Records the largest number of values that ncempy reads from the file at once.
+    largest_read = [0]
+    fromfile = dm.fileDM.fromfile
+
+    def counting_fromfile(self, *args, **kwargs):
+        largest_read[0] = max(largest_read[0], kwargs.get('count', 1))
+        return fromfile(self, *args, **kwargs)
+
+    dm.fileDM.fromfile = counting_fromfile
+    try:
+        header = em.read_header(path)
+        assert largest_read[0] < img.size, 'read_header reads the pixel data'
+        assert header == em.ImageHeader('fixture', (300, 200), np.dtype(np.float32), 0.25), 'wrong header: ' + repr(header)
+
+        with em.open_image(path, mmap=True) as (filename, mapped, pixel_size):
+            assert isinstance(mapped, np.memmap), 'open_image(mmap=True) does not memory-map the image'
+            assert largest_read[0] < img.size, 'open_image(mmap=True) reads the pixel data'
+            assert np.array_equal(mapped, img) and abs(pixel_size - 0.25) < 1e-6, 'the memory-mapped image is wrong'
+    finally:
+        dm.fileDM.fromfile = fromfile
+
+    with em.open_image(path, mmap=False, dtype='float64') as (filename, in_memory, pixel_size):
+        assert in_memory.dtype == np.float64 and np.array_equal(in_memory, img), 'open_image(mmap=False) is wrong'
+    frames = list(em.iter_frames(path))
+    assert len(frames) == 1 and np.array_equal(frames[0], img), 'iter_frames is wrong'
+
+
+def wait_for_job(service, job_id, timeout=120):
+    """This function waits until a job of a WorkerService is no longer queued or running, and returns its progress."""
+    deadline = time.time() + timeout
+    while True:
+        progress = service.progress(job_id)
+        if progress['state'] not in ('queued', 'running'):
+            return progress
+        assert time.time() < deadline, 'the job is stuck: ' + repr(progress)
+        time.sleep(0.1)
+
+
+def check_service_recovery(folder):
+    """This function checks that the worker service survives the death of a worker process: a worker is killed while a job is
+    running, and both that job and a job submitted afterwards must finish with all their images processed."""
+    import mrcfile
+    images = []
+    for seed in range(8):
+        path = os.path.join(folder, 'image_' + str(seed) + '.mrc')
+        with mrcfile.new(path) as mrc:
+            mrc.set_data(synthetic_micrograph(768, 6, seed=seed)[0])
+            mrc.voxel_size = 5.0  # In Angstrom, that is 0.5 nm.
+        images.append(path)
+
+    service = nanorod_service.WorkerService(processes=2)
+    try:
+        first_job = service.submit(images, os.path.join(folder, 'first'), figures='none')
+        deadline = time.time() + 60
+        while service.progress(first_job)['done'] == 0:  # Waits until the workers are busy with the job.
+            assert time.time() < deadline, 'the first job does not start'
+            time.sleep(0.05)
+        os.kill(next(iter(service.executor._processes)), signal.SIGKILL)
+
+        progress = wait_for_job(service, first_job)
+        assert progress['state'] == 'done' and progress['done'] == len(images), 'the first job did not recover: ' + repr(progress)
+        second_job = service.submit(images[:2], os.path.join(folder, 'second'), figures='none')
+        progress = wait_for_job(service, second_job)
+        assert progress['state'] == 'done' and progress['done'] == 2, 'the next job did not run: ' + repr(progress)
+        assert service.in_flight == 0, 'images are still counted in flight'
+    finally:
+        service.close()
+
+
+def check_service_access(folder):
+    """This function checks that the worker service can only be used by its user: its Unix socket has the permissions 0600, the
+    requests without its token are refused, a second service can't take its socket over, and it refuses to listen on a TCP port
+    without a token."""
+    address = os.path.join(folder, 'service', 'service.sock')
+    token_path = os.path.join(folder, 'service.token')
+    client = nanorod_service.start_service(address, processes=1, log_path=os.path.join(folder, 'service.log'), token_path=token_path)
+    try:
+        assert stat.S_IMODE(os.stat(token_path).st_mode) == 0o600, 'the token can be read by other users'
+        assert stat.S_IMODE(os.stat(address).st_mode) == 0o600, 'the socket can be opened by other users'
+        assert client.ping()['pid'] > 0
+        for token in (None, 'wrong'):
+            intruder = nanorod_service.ServiceClient(address)
+            if token is not None:
+                intruder.token_path = os.path.join(folder, 'wrong.token')
+                with open(intruder.token_path, 'w') as token_file:
+                    token_file.write(token)
+            try:
+                intruder.submit([os.path.join(folder, 'image.mrc')], folder)
+            except RuntimeError as error:
+                assert 'Invalid token' in str(error), 'unexpected error: ' + repr(error)
+            else:
+                raise AssertionError('a request with the token ' + repr(token) + ' was accepted')
+
+        # A second service started on the socket must leave the running one alone, and exit.
+        pid = client.ping()['pid']
+        command = [sys.executable, nanorod_service.__file__, '--socket', address, '--token-file', token_path, '--processes', '1']
+        second = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            second.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            raise AssertionError('a second service took the socket over')
+        finally:
+            if second.poll() is None:
+                second.kill()
+        assert client.ping()['pid'] == pid, 'the running service no longer answers on its socket'
+    finally:
+        client.shutdown()
+
+    command = [sys.executable, nanorod_service.__file__, '--port', '0']
+    output = subprocess.run(command, capture_output=True, text=True, timeout=60)
+    assert output.returncode != 0 and 'token is required' in output.stderr, 'the service listens on TCP without a token'
+
+
+def check_result_store(folder):
+    """This function checks that the histograms and summaries of a ResultStore count the lengths outside the bins, and that its
+    median is exact when the lengths lie outside the bins or the length range doesn't fall on their edges."""
+    with em.ResultStore(os.path.join(folder, 'store.sqlite')) as store:
+        lengths = [100, 1200, 1500]
+        store.write_image('grid', 'image', [1, 2, 3], [0] * 3, [0] * 3, [1] * 3, lengths)
+        for length_range in (None, (0, 1300), (0, 5000)):
+            expected = [length for length in lengths if length_range is None or length <= length_range[1]]
+            summary = store.summary(length_range=length_range)
+            assert summary['count'] == len(expected), 'wrong count: ' + repr(summary)
+            assert sum(store.histogram(length_range=length_range)) == len(expected), 'the histogram loses lengths'
+            assert summary['median'] == np.median(expected), 'wrong median: ' + repr(summary)
+
+        # A range that doesn't fall on the edges of the bins: the median must be over the nanorods that are counted.
+        lengths = np.random.default_rng(0).uniform(40, 200, 1000)
+        store.write_image('grid', 'image', np.arange(1000), np.zeros(1000), np.zeros(1000), np.ones(1000), lengths)
+        summary = store.summary(length_range=(52, 148))
+        expected = lengths[(lengths >= 52) & (lengths <= 148)]
+        assert summary['count'] == len(expected), 'wrong count: ' + repr(summary)
+        assert abs(summary['median'] - np.median(expected)) < 1e-9, 'wrong median: ' + repr(summary)
+
+
+def check_missing_modules(folder):
+    """This function checks that the worker service processes DM4 images without mrcfile, which the Shiny app doesn't install:
+    preload must skip it, and the workers must start all the same."""
+    path = os.path.join(folder, 'image.dm4')
+    write_dm4(path, synthetic_micrograph(768, 6, seed=0)[0], 0.5)
+    mrcfile = sys.modules.get('mrcfile')
+    sys.modules['mrcfile'] = None  # Makes "import mrcfile" fail, here and in the forked workers.
+    try:
+        assert em.preload()['mrcfile'] is None, 'preload does not report mrcfile as missing'
+        service = nanorod_service.WorkerService(processes=1)
+        try:
+            job_id = service.submit([path], os.path.join(folder, 'output'), figures='none')
+            progress = wait_for_job(service, job_id)
+            assert progress['state'] == 'done' and progress['done'] == 1 and progress['failed'] == 0, \
+                'the image failed without mrcfile: ' + repr(service.result(job_id)['errors'])
+        finally:
+            service.close()
+    finally:
+        if mrcfile is None:
+            del sys.modules['mrcfile']
+        else:
+            sys.modules['mrcfile'] = mrcfile
+
+
+def canonical_labels(labels):
+    """This function renumbers the objects of a labelled image in the raster order of their first pixel, so that two
+    segmentations can be compared whatever the numbers of their objects."""
+    labels = np.asarray(labels)
+    values, first = np.unique(labels.ravel(), return_index=True)
+    first, values = first[values > 0], values[values > 0]
+    lut = np.zeros(int(labels.max(initial=0)) + 1, dtype=np.int64)
+    lut[values[np.argsort(first)]] = np.arange(1, len(values) + 1)
+    return lut[labels]
+
+
+def check_segment_tiled(folder):
+    """This function checks that segment_tiled finds the same objects as img_prep followed by watershedding, with the full-size
+    arrays in memory and on disk: a nanorod across a seam of the tiles is counted once, and an object cut by the edge of the image
+    is removed as by clear_border."""
+    img, rods = synthetic_micrograph(1280, 12, seed=1)
+    row, col, _ = rods[0]
+    img[600:640, :150] += 3  # An object cut by the left edge of the image, where there are no nanorods.
+    prep_parameters = {'block_size': 301}
+    reference = canonical_labels(em.watershedding(em.img_prep(img, **prep_parameters)))
+    assert reference[620, 75] == 0 and reference[int(round(row)), int(round(col))] > 0, 'unexpected reference segmentation'
+
+    # The first tiling puts a seam through the middle of the first nanorod; the small budget puts the full-size arrays on disk.
+    for tile_size, memory_budget in ((int(round(row)), None), (2048, 3 * img.size)):
+        labels = em.segment_tiled(img, tile_size=tile_size, memory_budget=memory_budget, **prep_parameters)
+        assert (memory_budget is not None) == isinstance(labels, np.memmap), 'the full-size arrays are not where expected'
+        assert labels.max() == reference.max(), 'segment_tiled counts ' + str(labels.max()) + ' objects, not ' + str(reference.max())
+        assert np.array_equal(canonical_labels(labels), reference), 'segment_tiled does not find the same objects'
+
+
+def legacy_filter_labels(labels, area_in_nm2, length_in_nm, pixel_size):
+    """This function filters the labels by area and minor axis length and reorders them like the original pipeline, one
+    regionprops pass and one full-image mask per label and per filter, as the reference of filter_labels."""
+    filtered = []
+    for keep in (
+        lambda region: region.area * pixel_size * pixel_size > area_in_nm2,
+        lambda region: region.minor_axis_length * pixel_size < length_in_nm,
+    ):
+        cleaned = np.zeros_like(labels)
+        for region in em.measure.regionprops(labels):
+            if keep(region):
+                cleaned[labels == region.label] = region.label
+        labels = cleaned
+        filtered.append(labels)
+    reordered = np.zeros_like(labels)
+    for k, region in enumerate(em.measure.regionprops(labels)):
+        reordered[labels == region.label] = k + 1
+    return filtered[-1], reordered
+
+
+def check_filter_labels(folder):
+    """This function checks that filter_labels keeps, and renumbers, the same labels as the original chain of filters."""
+    for size, n_rods, seed in ((1024, 10, 0), (1536, 30, 1)):
+        img, _ = synthetic_micrograph(size, n_rods, seed=seed)
+        labels = em.watershedding(em.img_prep(img))
+        for area_in_nm2, length_in_nm in ((500, 40), (3000, 20), (0, 1000)):
+            filters = [em.area_filter(area_in_nm2, 0.5), em.minor_axis_length_filter(length_in_nm, 0.5)]
+            filtered, reordered = legacy_filter_labels(labels, area_in_nm2, length_in_nm, 0.5)
+            assert np.array_equal(em.filter_labels(labels, filters), filtered), 'filter_labels keeps other labels'
+            assert np.array_equal(em.filter_labels(labels, filters, reorder=True), reordered), 'filter_labels reorders differently'
+
+
+def per_component_watershedding(binary, seed_threshold=0.2):
+    """This function does the same as watershedding, but with the seeds of each connected component taken relative to its own
+    largest distance, on the whole image at once, as the reference of watershedding_components(per_component=True)."""
+    distance = em.ndi.distance_transform_edt(binary)
+    components, n_components = em.ndi.label(binary, structure=np.ones((3, 3)))
+    largest = em.ndi.maximum(distance, components, np.arange(n_components + 1))
+    markers = em.ndi.label(distance > np.asarray(largest)[components] * seed_threshold)[0]
+    return em.segmentation.clear_border(em.segmentation.watershed(-distance, markers, mask=binary))
+
+
+def check_watershedding_components(folder):
+    """This function checks that watershedding_components gives the same labels, with the same numbers, as watershedding, and
+    with per-component seeds as the same watershed on the whole image. A big blob is added to the second mask, so that the
+    largest distance of the image is much larger than that of the nanorods."""
+    for size, n_rods, seed, blob in ((1024, 10, 0, False), (2048, 60, 1, True)):
+        binary = em.img_prep(synthetic_micrograph(size, n_rods, seed=seed)[0])
+        if blob:
+            rows, cols = np.ogrid[:size, :size]
+            binary[(rows - (size - 200))**2 + (cols - 200)**2 < 120**2] = True  # Added to the mask, which the thresholding would hollow.
+        labels = em.watershedding_components(binary)
+        assert labels.max() > 0 and np.array_equal(labels, em.watershedding(binary)), 'the labels differ from watershedding'
+        labels = em.watershedding_components(binary, per_component=True)
+        assert np.array_equal(labels, per_component_watershedding(binary)), 'the labels with per-component seeds differ'
+
+
+CHECKS = {
+    'dm_loader': check_dm_loader,
+    'service_recovery': check_service_recovery,
+    'service_access': check_service_access,
+    'result_store': check_result_store,
+    'missing_modules': check_missing_modules,
+    'segment_tiled': check_segment_tiled,
+    'filter_labels': check_filter_labels,
+    'watershedding_components': check_watershedding_components,
+}
+
+
+def main(argv=None):
+    names = (sys.argv[1:] if argv is None else argv) or list(CHECKS)
+    failed = []
+    for name in names:
+        with tempfile.TemporaryDirectory() as folder:
+            try:
+                CHECKS[name](folder)
+                print('passed', name)
+            except Exception:
+                failed.append(name)
+                print('FAILED', name)
+                traceback.print_exc()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,266 +5,430 @@ Created on Thu Jun 10 14:27:10 2021
 @author: Sergio G. Lopez from the Bioimaging Facility of the John Innes Centre.
 """
 
-# Imports the necessary libraries.
-from ncempy.io import dm
-import numpy as np
-import matplotlib.pyplot as plt
-from skimage import filters, morphology, segmentation, measure, color
-from scipy import ndimage as ndi
-import pandas as pd
+# Imports the necessary libraries. pandas and skimage are only imported when they are first used, and tkinter only when the
+# folder has to be chosen in a dialog window, so the script starts fast and runs on machines without a display.
 import glob
-import tkinter as tk
-from tkinter import filedialog
 import os
-import mrcfile
+import sys
+import time
+import argparse
+import json
 from datetime import datetime
+from collections import namedtuple, deque
+from concurrent.futures import ProcessPoolExecutor
+from electron_microscopy import (
+    LazyModule, preload, ResultStore, plotfig, FigureRenderer, StageProfiler, THRESHOLD_METHODS, WATERSHED_METHODS,
+    DEFAULT_PARAMETERS, process_image_file
+)
 
+pd = LazyModule('pandas')
 
-def open_mrc(filepath):
-    """This function opens an MRC file and returns the name of the image, the image itself, and the pixel size in nm."""
-    mrc = mrcfile.open(filepath)  # Opens the mrc file.
-    filename = filepath.split('.')[-2].split('\\')[-1]  # This gets the filename.
-    img = mrc.data  # Gets the image.
-    pixel_size = mrc.voxel_size['x'] * 0.1  # Gets the pixel size in nm.
-
-    return filename, img, pixel_size
-
-
-def open_DM4(filepath):
-    """This function opens the DM4 image and returns the name of the image, the image itself, and the pixel size."""
-    fileDM4 = dm.dmReader(filepath)  # Imports the dm4 image as a dictionary.
-    filename = fileDM4['filename']  # Gets the name of the image.
-    filename = filename.split('.')[0]  # Removes the '.dm4' extension from the name of the image.
-    img = fileDM4['data']  # Gets the image itself as a float32 Numpy array.
-    pixel_size = fileDM4['pixelSize'][0]  # Gets the pixel size in nm.
-
-    return filename, img, pixel_size
-
-
-def img_prep(img,
-             block_size=301,
-             erosions=1,
-             dilations=5,
-             small_object_removal=2000,
-             small_holes_removal=500):
-    """This function performs an adaptive thresholding, followed by erosions, followed by small objects removal, followed by dilations,
-    followed by small holes removal. The output is the processed image"""
-    thresh = filters.threshold_local(img, block_size, offset=0) # Computes a threshold mask image based on the local pixel neighborhood. Also known as adaptive or dynamic thresholding.
-    binary_local = img > thresh  # Uses the threshold to obtain a binary image.
-
-    for i in range(erosions):  # Erodes the image a number of times.
-        binary_local = morphology.binary_erosion(binary_local)
-    binary_local = morphology.remove_small_objects(binary_local, small_object_removal)  # Removes small objects.
-
-    for i in range(dilations):  # Dilates the image a number of times.
-        binary_local = morphology.binary_dilation(binary_local)
-    binary_local = morphology.remove_small_holes(binary_local, small_holes_removal)  # Removes small holes in the objects.
-
-    return binary_local
-
-
-def watershedding(binary_img, seed_threshold=0.2):
-    """This function watersheds the objects to separate them. It's followed by the removal of small objects."""
-    distance = ndi.distance_transform_edt(binary_img) # Applies a distance transform to the image.
-    local_maxi = np.copy(distance) # We make a copy of our image so as not to destroy the original.
-    local_maxi = local_maxi > (np.max(local_maxi) * seed_threshold)  # We take a threshold based on the size of the objects. The middle 20% remains as a seed for each region.
-    markers = ndi.label(local_maxi)[0]
-    labels = segmentation.watershed(-distance, markers, mask=binary_img)  # Now we run the watershed algorithm and connect the objects to each seed point.
-    labels = segmentation.clear_border(labels)  # Removes the objects that touch the edges of the image.
-
-    return labels
-
-
-def plotfig(img, labels, region_properties, filename, output_dir):
-    """This function takes the labelled image, the properties of the labels, and the name of the image and then plots (and saves) the figure."""
-    fig, ax = plt.subplots(1, 2, figsize=(15, 8))
-    ax[0].imshow(color.label2rgb(
-        labels,
-        bg_label=0,
-        colors=[
-            'red', 'violet', 'orange', 'green', 'blue',
-            'magenta', 'purple', 'crimson', 'lime', 'maroon',
-            'mediumvioletred', 'goldenrod', 'darkgreen',
-            'fuchsia', 'cornflowerblue', 'navy', 'hotpink',
-            'grey', 'chocolate', 'peru'
-        ]
-    ))
-    ax[0].set_title('Selected objects', fontsize=16)
-    for i in region_properties:
-        ax[0].text(i.centroid[1], i.centroid[0], i.label, color='white')
-    ax[1].imshow(img, cmap='Greys_r')
-    ax[1].contour(labels, colors='r', linewidths=0.8)
-    ax[1].set_title('Original', fontsize=16)
-    plt.tight_layout()
-    plot_path = os.path.join(output_dir, os.path.basename(filename) + '.png')
-    # print(plot_path)
-    plt.savefig(plot_path, dpi=600)
-    plt.close()
-
-
-def filter_labels_by_eccentricity(labels, eccentricity):
-    """This function filters out labels that have an eccentricity below the value of the "eccentricity" parameter. The output is a labelled image."""
-    props = measure.regionprops(labels)
-    labels_cleaned = np.zeros_like(labels)
-    for i in props:
-        if i.eccentricity > eccentricity:
-            labels_cleaned[labels == i.label] = i.label
-
-    return labels_cleaned
-
-
-def filter_labels_by_minor_axis_length(labels, length_in_nm, pixel_size):
-    """This function filters out labels that have a minor axis length above the value of the "length in nm" parameter. The output is a labelled image."""
-    props = measure.regionprops(labels)
-    labels_cleaned = np.zeros_like(labels)
-    for i in props:
-        if i.minor_axis_length * pixel_size < length_in_nm:
-            labels_cleaned[labels == i.label] = i.label
-
-    return labels_cleaned
-
-
-def create_length_prop(properties, pixel_size):
-    """This function creates two additional region properties in the list of region properties that is produced by skimage.measure.regionprops.
-    The input is a regionprops list and the output is a regionprops list with a property called "length" and a property called "area_to_length".
-    length = np.sqrt((feret_diameter_max*pixel_size)**2 - (18**2) # From Pythagoras's theorem.
-    area_to_length = (area*pixel_size*pixel_size) / length # Should be arounf 18."""
-    for i in properties:
-        i.length = np.sqrt((i.feret_diameter_max * pixel_size)**2 - 18**2)
-        i.area_to_length = (i.area * pixel_size * pixel_size) / i.length
-
-    return properties
-
-
-def filter_labels_by_area(labels, area_in_nm2, pixel_size):
-    """This function filters out labels that have an area below the value of the "area" parameter. The output is a labelled image."""
-    props = measure.regionprops(labels)
-    labels_cleaned = np.zeros_like(labels)
-    for i in props:
-        if i.area * pixel_size * pixel_size > area_in_nm2:
-            labels_cleaned[labels == i.label] = i.label
-
-    return labels_cleaned
-
-
-def filter_labels_by_area_to_width_ratio(labels, pixel_size, min_ratio,
-                                         max_ratio):
-    """This function filters out labels that have area to width ratios that fall outside the min_ratio to max_ratio interval."""
-    props = measure.regionprops(labels)
-    props = create_length_prop(props, pixel_size)
-    labels_cleaned = np.zeros_like(labels)
-    for i in props:
-        if i.area_to_length >= min_ratio and i.area_to_length <= max_ratio:
-            labels_cleaned[labels == i.label] = i.label
-    return labels_cleaned
-
-
-def reorder_labels(labels):
-    """This function reorders the labels so as to make them start from 1."""
-    props = measure.regionprops(labels)
-    labels_cleaned = np.zeros_like(labels)
-    for i, j in enumerate(props):
-        labels_cleaned[labels == j.label] = i + 1
-    return labels_cleaned
+
+# Compact per-image result returned by the workers: the path of the image, a dataframe with one row per nanorod (None if
+# no nanorods were kept), the labelled image (None unless requested), the processing time in seconds and the records of the
+# StageProfiler of the image (the time, memory and number of objects of each stage).
+ImageResult = namedtuple('ImageResult', ['filepath', 'data', 'labels', 'seconds', 'profile'])
+
+# Columns of the nanorod table.
+NANOROD_COLUMNS = ['Image name', 'Nanorod ID', 'Coordinate in Y', 'Coordinate in X', 'Area in nm square', 'Length in nm']
+
+# Name of the file, in the analysis folder, that records which images have been processed.
+MANIFEST_FILENAME = 'manifest.jsonl'
+
+# Name of the file, in the analysis folder, where the nanorods and the per-image summaries of the whole session are stored.
+STORE_FILENAME = 'nanorods.sqlite'
+
+# Name of the file, in the analysis folder, where the profile of every stage of every image is traced as JSON lines.
+PROFILE_FILENAME = 'profile.jsonl'
+
+# Figure renderers of this process, by figure mode.
+FIGURE_RENDERERS = {}
+
+
+def figure_renderer(mode):
+    """This function returns the FigureRenderer of this process for the given figure mode, creating it on first use. Each worker
+    process draws its figures in a background thread while it segments the next image."""
+    if mode not in FIGURE_RENDERERS:
+        FIGURE_RENDERERS[mode] = FigureRenderer(mode, plot_function=plotfig)
+    return FIGURE_RENDERERS[mode]
+
+
+def mrc_image_name(filepath):
+    """This function returns the name under which the nanorods of an MRC image are saved."""
+    return os.path.splitext(os.path.basename(filepath))[0] + '.mrc'
+
+
+def process_image(filepath, output_dir, return_labels=False, parameters=None, figures='full'):
+    """This function runs the whole pipeline on a single MRC image and returns an ImageResult. It doesn't touch any shared state,
+    so it can run in a worker process. The pipeline is that of process_image_file, shared with the worker service; the pipeline
+    parameters that are not given in "parameters" take their DEFAULT_PARAMETERS value.
+    The figure is drawn by the background renderer of the process while the nanorods are measured, and is saved before the result
+    is returned; "figures" is "full", "preview" or "none" (see FigureRenderer).
+    Every stage is run through a StageProfiler, whose records are returned in the "profile" of the result."""
+    start = time.perf_counter()
+    profiler = StageProfiler()
+    image = mrc_image_name(filepath)
+    processed = process_image_file(
+        filepath, output_dir, parameters, profiler=profiler, renderer=figure_renderer(figures), image=image
+    )
+    table = processed.table
+
+    data = None
+    if len(table['label']) > 0:
+        # Transforms the table of nanorod properties into a Pandas dataframe.
+        data = pd.DataFrame({
+            'Image name': image,
+            'Nanorod ID': table['label'],
+            'Coordinate in Y': table['centroid-0'],
+            'Coordinate in X': table['centroid-1'],
+            'Area in nm square': table['area'],
+            'Length in nm': table['length'],
+        }, columns=NANOROD_COLUMNS)
+
+    return ImageResult(filepath, data, processed.labels if return_labels else None, time.perf_counter() - start, profiler.records)
 
 
 def run_pipeline(filepath, out_df, output_dir):
-    # Opens and labels the images.
-    filename, img, pixel_size = open_mrc(filepath)  # Opens the image.
-    binary = img_prep(img)  # Prepares the image to be labelled.
-    labels = watershedding(binary)  # Watersheds and labels the image.
-    labels = filter_labels_by_area(labels, 500, pixel_size)
-    labels = filter_labels_by_minor_axis_length(labels, 40, pixel_size)
-    labels = reorder_labels(labels)
-
-    # Obtains the properties of the labels.
-    labels_properties = measure.regionprops(labels)
-    labels_properties = create_length_prop(labels_properties, pixel_size)
-
-    if len(labels_properties) > 0:
-        # Plots and saves the images.
-        plotfig(img, labels, labels_properties, filename, output_dir)
-        # Creates a table containing the nanorod properties.
-        table = measure.regionprops_table(labels, properties=('label', 'centroid', 'area'))
-        # Transforms the table into a Pandas dataframe.
-        data = pd.DataFrame(table)
-        # Converts the area of the nanorod in pixels into area in nm square.
-        data['area'] = pixel_size * pixel_size * data['area']  # Transforms the area in pixels into areas in nm square.
-        # Creates a list with the name of the image.
-        list_image_name = [os.path.basename(filename) + '.mrc' for i in range(data.shape[0])]
-        # Inserts this list as a column in the dataframe.
-        data.insert(0, 'Image name', list_image_name)
-
-        # Creates a list with the lengths obtained from the Pythagoras theorem.
-        lengths = []
-        for i in labels_properties:
-            lengths.append(i.length)
-
-        # Inserts this list as a column in the dataframe.
-        data.insert(5, 'Length in nm', lengths)
-        # Renames the columns of the dataframe.
-        data.rename(
-            columns={
-                'label': 'Nanorod ID',
-                'centroid-0': 'Coordinate in Y',
-                'centroid-1': 'Coordinate in X',
-                'area': 'Area in nm square'
-            },
-            inplace=True
+    """This function runs the pipeline on a single MRC image and appends its nanorods to "out_df"."""
+    result = process_image(filepath, output_dir)
+    if result.data is not None:
+        out_df = pd.concat([out_df, result.data], ignore_index=True)
+
+    return out_df
+
+
+class CsvResultsWriter:
+    """This class streams the nanorod rows of each image to a CSV file as soon as the image is processed. The rows are flushed
+    after every image, so the results of the images processed so far survive a crash.
+    If "keep" is a set of image names, the rows of those images already in the file are kept and the rest are dropped."""
+    extension = '.csv'
+
+    def __init__(self, path, keep=None):
+        self.path = path
+        kept = None
+        if keep and os.path.exists(path):
+            kept = pd.read_csv(path)
+            kept = kept[kept['Image name'].isin(keep)]
+        self.file = open(path, 'w', newline='')
+        pd.DataFrame(columns=NANOROD_COLUMNS).to_csv(self.file, index=False)  # Writes the header.
+        if kept is not None:
+            kept.to_csv(self.file, header=False, index=False)
+        self.file.flush()
+
+    @staticmethod
+    def row_counts(path):
+        """This function returns the number of rows saved for each image in an existing results file."""
+        if not os.path.exists(path):
+            return {}
+        return pd.read_csv(path, usecols=['Image name'])['Image name'].value_counts().to_dict()
+
+    def write(self, data):
+        data.to_csv(self.file, header=False, index=False)
+        self.file.flush()
+
+    def read(self):
+        return pd.read_csv(self.path)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ParquetResultsWriter:
+    """This class streams the nanorod rows of each image to a Parquet dataset, that is a folder with one Parquet file per image.
+    Every file is complete as soon as it is written, so the results of the images processed so far survive a crash.
+    If "keep" is a set of image names, the files of those images already in the folder are kept and the rest are deleted.
+    It needs pyarrow or fastparquet to be installed."""
+    extension = '.parquet'
+
+    def __init__(self, path, keep=None):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        for part in glob.glob(os.path.join(path, '*.parquet')):
+            if keep is None or self.part_image_name(part) not in keep:
+                os.remove(part)
+
+    @staticmethod
+    def part_image_name(part):
+        return os.path.splitext(os.path.basename(part))[0] + '.mrc'
+
+    @staticmethod
+    def row_counts(path):
+        """This function returns the number of rows saved for each image in an existing results dataset."""
+        return {
+            ParquetResultsWriter.part_image_name(part): len(pd.read_parquet(part, columns=['Image name']))
+            for part in glob.glob(os.path.join(path, '*.parquet'))
+        }
+
+    def write(self, data):
+        part = os.path.splitext(data['Image name'].iloc[0])[0] + '.parquet'  # One file per image, named after it.
+        data.to_parquet(os.path.join(self.path, part), index=False)
+
+    def read(self):
+        if len(glob.glob(os.path.join(self.path, '*.parquet'))) == 0:
+            return pd.DataFrame(columns=NANOROD_COLUMNS)
+        return pd.read_parquet(self.path)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+# Formats in which the nanorod rows can be streamed to disk.
+RESULTS_WRITERS = {'csv': CsvResultsWriter, 'parquet': ParquetResultsWriter}
+
+
+def results_path(output_folder, results_format='csv'):
+    """This function returns the path of "Nanorod.<format>" in the output folder of a GridSquare."""
+    return os.path.join(output_folder, 'Nanorod' + RESULTS_WRITERS[results_format].extension)
+
+
+def open_results_writer(output_folder, results_format='csv', keep=None):
+    """This function opens a results writer for "Nanorod.<format>" in the output folder of a GridSquare."""
+    return RESULTS_WRITERS[results_format](results_path(output_folder, results_format), keep=keep)
+
+
+def file_signature(filepath, parameters):
+    """This function returns what identifies one processing of an image: its path, size, modification time and the pipeline parameters."""
+    stat = os.stat(filepath)
+    return {'path': filepath, 'size': stat.st_size, 'mtime': stat.st_mtime, 'parameters': parameters}
+
+
+def read_manifest(manifest_path):
+    """This function reads the manifest of a batch and returns its latest entry for each image path. A truncated last line,
+    left by a crash, is ignored."""
+    manifest = {}
+    if not os.path.exists(manifest_path):
+        return manifest
+    with open(manifest_path) as manifest_file:
+        for line in manifest_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            manifest[entry['path']] = entry
+    return manifest
+
+
+def is_processed(entry, signature, row_counts):
+    """This function tells whether a manifest entry shows that an image has already been processed, with the same file and
+    parameters, and that all of its nanorods are still saved."""
+    return (
+        entry is not None
+        and entry['status'] == 'done'
+        and all(entry[key] == value for key, value in signature.items())
+        and row_counts.get(mrc_image_name(signature['path']), 0) == entry['rows']
+    )
+
+
+def export_excel(writer, xlsx_filename, image_names=None):
+    """This function reads back the nanorod rows streamed by a results writer and saves them as an Excel spreadsheet.
+    If "image_names" is given, the rows are sorted in that order of images (a resumed batch writes the rerun images last)."""
+    data = writer.read()
+    if image_names is not None:
+        order = {name: i for i, name in enumerate(image_names)}
+        data = data.sort_values('Image name', key=lambda names: names.map(order), kind='stable', ignore_index=True)
+    data.to_excel(xlsx_filename)
+
+
+def list_grid_images(folder_selected):
+    """This function lists the MRC images of every GridSquare folder of an acquisition session, in the same order as they are
+    found in "Images-Disc1/*/Data/". The output is a list of (GridSquare folder, list of image paths) pairs."""
+    images_folder = os.path.join(folder_selected, 'Images-Disc1')
+    grid_images = []
+    for folder in os.listdir(images_folder):
+        folder_path = os.path.join(images_folder, folder, 'Data')
+        grid_images.append((folder, glob.glob(os.path.join(folder_path, '*.mrc'))))
+
+    return grid_images
+
+
+def submit_bounded(executor, function, arguments, max_pending):
+    """This function submits "function" to "executor" for each tuple of "arguments", in order, with at most "max_pending" of them in
+    flight, and yields their futures in the same order. Each future is dropped here once it is yielded, so the caller holds the only
+    reference to it and its result is freed as soon as the caller is done with it."""
+    pending = deque()
+    for args in arguments:
+        pending.append(executor.submit(function, *args))
+        if len(pending) >= max_pending:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+
+def run_batch(folder_selected, analysis_dir, processes=None, return_labels=False, results_format='csv', excel=True,
+              parameters=None, resume=False, figures='full'):
+    """This function processes every GridSquare of an acquisition session with a pool of "processes" worker processes (all the
+    cores by default). One output folder is written per GridSquare in "analysis_dir". The nanorods of each image are streamed
+    to Nanorod.csv (or to the Nanorod.parquet dataset) as soon as the image is done, and are exported to Nanorod.xlsx once the
+    GridSquare is complete if "excel" is True. "figures" is "full", "preview" or "none" (see FigureRenderer).
+    Every processed or failed image is recorded in the manifest of "analysis_dir", and the profile of every stage of every processed
+    image is appended to its profile trace; the stages that took the longest are printed at the end. The nanorods of the whole
+    session are also saved in a ResultStore in "analysis_dir", with the summary of each image. If "resume" is True, the images whose file and
+    parameters are unchanged and whose nanorods are still saved are skipped, and only new, changed or failed images are processed.
+    The output is a list of (GridSquare folder, list of ImageResult) pairs, ordered like list_grid_images whatever the order in
+    which the workers finish. The nanorod rows are not kept in the returned results, they are on disk."""
+    parameters = dict(DEFAULT_PARAMETERS, **(parameters or {}))
+    grid_images = list_grid_images(folder_selected)
+    manifest_path = os.path.join(analysis_dir, MANIFEST_FILENAME)
+    manifest = read_manifest(manifest_path) if resume else {}
+    batch_results = []
+    profiler = StageProfiler(memory=None, trace_path=os.path.join(analysis_dir, PROFILE_FILENAME))
+    store = ResultStore(os.path.join(analysis_dir, STORE_FILENAME))
+
+    # Imports the libraries before the workers are started, so that they start with them already loaded where the workers are
+    # forked; where they are spawned, each worker imports them when it starts.
+    import_seconds = sum(seconds for seconds in preload(plotting=figures != 'none').values() if seconds is not None)
+    print("Libraries imported in", round(import_seconds, 2), "s")
+
+    with open(manifest_path, 'a' if resume else 'w') as manifest_file, \
+            ProcessPoolExecutor(max_workers=processes, initializer=preload, initargs=(figures != 'none',)) as executor:
+        # Lists the images to process in every GridSquare first.
+        grid_tasks = []
+        for folder, path_list in grid_images:
+            output_folder = os.path.join(analysis_dir, folder)
+            os.makedirs(output_folder, exist_ok=True)
+
+            row_counts = RESULTS_WRITERS[results_format].row_counts(results_path(output_folder, results_format)) if resume else {}
+            signatures = {filepath: file_signature(filepath, parameters) for filepath in path_list}
+            processed = [
+                filepath for filepath in path_list
+                if is_processed(manifest.get(filepath), signatures[filepath], row_counts)
+            ]
+            signatures = [signatures[filepath] for filepath in path_list if filepath not in processed]
+            grid_tasks.append((folder, output_folder, path_list, processed, signatures))
+
+        # Submits the images of the whole session in order, across the GridSquares so that the pool is never idle between them,
+        # but with a bounded number of images in flight, so that the memory used by the results doesn't grow with the session.
+        submissions = submit_bounded(
+            executor,
+            process_image,
+            [
+                (signature['path'], output_folder, return_labels, parameters, figures)
+                for _, output_folder, _, _, signatures in grid_tasks for signature in signatures
+            ],
+            max_pending=2 * (processes or os.cpu_count() or 1)
         )
-        # Appends this local dataframe to the great dataframe that contains nanorods from all of the images.
-        out_df = out_df.append(data, ignore_index=True)
-
-        # Deletes the variables to release memory.
-        del img, labels, binary, data, labels_properties
-
-    return (out_df)
-
-
-# Creates a dialog window to obtain the folder in which the images are.
-root = tk.Tk()
-root.withdraw()
-folder_selected = filedialog.askdirectory(title='Select the folder that contains the images.')
-base_path = os.path.dirname(folder_selected)
-
-# Create analysis results folder
-analysis_folder = 'Analysis_' + os.path.basename(
-    folder_selected) + '_' + datetime.strftime(datetime.now(), "%Y-%m-%d_%H%M")
-analysis_folder = analysis_folder.replace(' ', '_')
-os.mkdir(os.path.join(base_path, analysis_folder))
-print("Results will be saved in", analysis_folder, "!")
-
-# List of GridSquare folders
-folder_selected = os.path.join(folder_selected, 'Images-Disc1')
-grid_folders = os.listdir(folder_selected)
-
-grid_count = 1
-for folder in grid_folders:
-    print("\n----------------------------------------")
-    print("Processing", folder, "(", grid_count, "/", len(grid_folders), ")...\n")
-    folder_path = os.path.join(folder, 'Data')
-    folder_path = os.path.join(folder_selected, folder_path)
-
-    # Create GridSquare output folders
-    output_folder = os.path.join(analysis_folder, folder)
-    output_folder = os.path.join(base_path, output_folder)
-    os.mkdir(output_folder)
-
-    # Creates the dataframe to which all the local dataframes will be appended.
-    great_dataframe = pd.DataFrame(columns=['Image name', 'Nanorod ID', 'Coordinate in Y', 'Coordinate in X', 'Area in nm square', 'Length in nm'])
-
-    # It opens each one of the images.
-    path_list = glob.glob(os.path.join(folder_path, '*.mrc'))
-
-    # Run main pipeline
-    count = 1
-    for filepath in path_list:
-        print("[", datetime.now(), "] ", "Processing file (", count, "/", len(path_list), ")...")
-        great_dataframe = run_pipeline(filepath, great_dataframe, output_folder)
-        count += 1
-
-    # Saves the great dataframe with all the data as an Excel spreadsheet.
-    xlsx_filename = os.path.join(output_folder, 'Nanorod.xlsx')
-    great_dataframe.to_excel(xlsx_filename)
-
-    grid_count += 1
+
+        # Collects the results in submission order, so the output is deterministic.
+        for grid_count, (folder, output_folder, path_list, processed, signatures) in enumerate(grid_tasks, start=1):
+            print("\n----------------------------------------")
+            print("Processing", folder, "(", grid_count, "/", len(grid_tasks), ")...\n")
+            if len(processed) > 0:
+                print("Skipping", len(processed), "files already processed.")
+            grid_results = []
+            with open_results_writer(output_folder, results_format, keep={mrc_image_name(i) for i in processed}) as writer:
+                for count, signature in enumerate(signatures, start=1):
+                    try:
+                        result = next(submissions).result()
+                    except Exception as error:
+                        print("[", datetime.now(), "] ", "Failed file (", count, "/", len(signatures), ")",
+                              os.path.basename(signature['path']), ":", repr(error))
+                        manifest_file.write(json.dumps(dict(signature, status='failed', rows=0)) + '\n')
+                        manifest_file.flush()
+                        continue
+
+                    print("[", datetime.now(), "] ", "Processed file (", count, "/", len(signatures), ")",
+                          os.path.basename(result.filepath), "in", round(result.seconds, 2), "s")
+                    rows = 0
+                    data = result.data if result.data is not None else pd.DataFrame(columns=NANOROD_COLUMNS)
+                    if result.data is not None:
+                        writer.write(result.data)  # Saves the nanorods of the image straight away.
+                        rows = len(result.data)
+                    store.write_image(
+                        folder, mrc_image_name(result.filepath), data['Nanorod ID'], data['Coordinate in Y'],
+                        data['Coordinate in X'], data['Area in nm square'], data['Length in nm']
+                    )
+                    # Records the image in the manifest once its nanorods are saved.
+                    manifest_file.write(json.dumps(dict(signature, status='done', rows=rows)) + '\n')
+                    manifest_file.flush()
+                    profiler.add(result.profile)
+                    grid_results.append(result._replace(data=None))
+
+                # Saves the nanorods of all the images of the GridSquare as an Excel spreadsheet.
+                if excel:
+                    export_excel(writer, os.path.join(output_folder, 'Nanorod.xlsx'), image_names=[mrc_image_name(i) for i in path_list])
+            batch_results.append((folder, grid_results))
+
+    profiler.close()
+    store.close()
+    summary = profiler.summary()
+    if len(summary['stage']) > 0:
+        print("\nTime spent in each stage by the workers:")
+        for stage, runs, wall_seconds in zip(summary['stage'], summary['runs'], summary['wall_seconds']):
+            print(" ", stage, ":", round(wall_seconds, 2), "s over", runs, "images")
+
+    return batch_results
+
+
+def select_folder():
+    """This function opens a dialog window to choose the folder of the session and returns it."""
+    import tkinter as tk
+    from tkinter import filedialog
+    root = tk.Tk()
+    root.withdraw()
+    return filedialog.askdirectory(title='Select the folder that contains the images.')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measures the nanorods of every GridSquare of an acquisition session.')
+    parser.add_argument('folder', nargs='?',
+                        help='Folder of the session. A dialog window is opened if it is not given, otherwise no window is used.')
+    parser.add_argument('-p', '--processes', type=int, default=None, help='Number of worker processes (default: all cores).')
+    parser.add_argument('-f', '--format', choices=sorted(RESULTS_WRITERS), default='csv',
+                        help='Format in which the nanorods are streamed to disk (default: csv).')
+    parser.add_argument('--no-excel', action='store_true', help='Does not export Nanorod.xlsx at the end of each GridSquare.')
+    parser.add_argument('-t', '--threshold-method', choices=sorted(THRESHOLD_METHODS), default='gaussian',
+                        help='Backend of the adaptive thresholding (default: gaussian).')
+    parser.add_argument('-w', '--watershed-method', choices=sorted(WATERSHED_METHODS), default='full',
+                        help='Watershed the whole image at once, or each connected component in parallel (default: full).')
+    parser.add_argument('--per-component-seeds', action='store_true',
+                        help='With the components method, takes the seeds of each component relative to its own largest distance.')
+    parser.add_argument('--figures', choices=('full', 'preview', 'none'), default='full',
+                        help='Figures saved for each image: full resolution, fast thumbnails, or none (default: full).')
+    parser.add_argument('-r', '--resume', metavar='ANALYSIS_FOLDER', default=None,
+                        help='Resumes the batch saved in this analysis folder, only processing new, changed or failed images.')
+    args = parser.parse_args(argv)
+
+    folder_selected = args.folder
+    if folder_selected is None:
+        folder_selected = select_folder()  # Creates a dialog window to obtain the folder in which the images are.
+    folder_selected = os.path.normpath(folder_selected)
+    base_path = os.path.dirname(folder_selected)
+
+    if args.resume is not None:
+        analysis_dir = os.path.normpath(args.resume)
+        print("Resuming the analysis saved in", analysis_dir, "!")
+    else:
+        # Create analysis results folder
+        analysis_folder = 'Analysis_' + os.path.basename(
+            folder_selected) + '_' + datetime.strftime(datetime.now(), "%Y-%m-%d_%H%M")
+        analysis_folder = analysis_folder.replace(' ', '_')
+        analysis_dir = os.path.join(base_path, analysis_folder)
+        os.mkdir(analysis_dir)
+        print("Results will be saved in", analysis_folder, "!")
+
+    start = time.perf_counter()
+    run_batch(folder_selected, analysis_dir, processes=args.processes,
+              results_format=args.format, excel=not args.no_excel,
+              parameters={
+                  'threshold_method': args.threshold_method,
+                  'watershed_method': args.watershed_method,
+                  'per_component_seeds': args.per_component_seeds,
+              }, resume=args.resume is not None,
+              figures=args.figures)
+    print("\nSession processed in", round(time.perf_counter() - start, 2), "s")
+
+
+if __name__ == '__main__':
+    sys.exit(main())
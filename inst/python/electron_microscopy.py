@@ -5,37 +5,366 @@ Created on Thu Jun 10 14:27:10 2021
 @author: Sergio G. Lopez from the Bioimaging Facility of the John Innes Centre.
 """
 
-# Imports the necessary libraries.
-from ncempy.io import dm
+# Imports the necessary libraries. The image libraries are only imported when they are first used (see LazyModule), and
+# matplotlib only when a figure is drawn, so that importing this file is fast.
 import numpy as np
-import matplotlib.pyplot as plt
-from skimage import filters, morphology, segmentation, measure, color
-from scipy import ndimage as ndi
+import importlib
+from collections import namedtuple, Counter, deque
+from itertools import product
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import os
+import sys
+import json
+import threading
+import hashlib
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+try:
+    import resource  # Not available on Windows, where the peak memory of the stages is then not recorded.
+except ImportError:
+    resource = None
 
 
-def open_DM4(filepath):
-    """This function opens the DM4 image and returns the name of the image, the image itself, and the pixel size."""
+class LazyModule:
+    """This class stands for a module that is imported the first time one of its attributes is used."""
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return getattr(self.module, attribute)
+
+
+dm = LazyModule('ncempy.io.dm')
+filters = LazyModule('skimage.filters')
+morphology = LazyModule('skimage.morphology')
+segmentation = LazyModule('skimage.segmentation')
+measure = LazyModule('skimage.measure')
+color = LazyModule('skimage.color')
+transform = LazyModule('skimage.transform')
+io = LazyModule('skimage.io')
+ndi = LazyModule('scipy.ndimage')
+
+# Modules of the image processing pipeline, imported by preload.
+PIPELINE_MODULES = [
+    'scipy.ndimage', 'scipy.spatial', 'skimage.filters', 'skimage.morphology', 'skimage.segmentation', 'skimage.measure',
+    'skimage.transform', 'ncempy.io.dm', 'mrcfile',
+]
+
+# Modules used to draw the figures, also imported by preload if asked.
+PLOTTING_MODULES = ['matplotlib.figure', 'matplotlib.ticker', 'matplotlib.colors', 'skimage.color', 'skimage.io']
+
+
+def preload(plotting=False):
+    """This function imports the modules of the pipeline straight away rather than on first use, for instance when a worker
+    process starts, so that its first image isn't slower than the others. The modules used to draw the figures are imported
+    too if "plotting" is True. The output is the number of seconds that the import of each module took (0 if it was already
+    imported), so that the start-up time of the workers can be reported, or None for the modules that aren't installed: these
+    are skipped, since not every front end needs all of them (mrcfile is only imported when an MRC file is opened)."""
+    seconds = {}
+    for name in PIPELINE_MODULES + (PLOTTING_MODULES if plotting else []):
+        start = time.perf_counter()
+        try:
+            importlib.import_module(name)
+        except ModuleNotFoundError as error:
+            if error.name is None or not (name + '.').startswith(error.name + '.'):
+                raise  # The module is installed, but one of its own dependencies is missing.
+            seconds[name] = None
+            continue
+        seconds[name] = time.perf_counter() - start
+    return seconds
+
+
+# A label filter is the list of regionprops properties it needs plus a test that takes the columnar property table
+# (as returned by skimage.measure.regionprops_table) and returns a boolean array with one entry per region.
+LabelFilter = namedtuple('LabelFilter', ['properties', 'test'])
+
+# Colours of the labels in the figures.
+LABEL_COLORS = [
+    'red', 'violet', 'orange', 'green', 'blue',
+    'magenta', 'purple', 'crimson', 'lime', 'maroon',
+    'mediumvioletred', 'goldenrod', 'darkgreen',
+    'fuchsia', 'cornflowerblue', 'navy', 'hotpink',
+    'grey', 'chocolate', 'peru'
+]
+
+# What read_header returns: the name of the image, the shape of its pixel data, their type, and the pixel size in nm.
+ImageHeader = namedtuple('ImageHeader', ['filename', 'shape', 'dtype', 'pixel_size'])
+
+
+def open_DM4(filepath, dtype=None):
+    """This function opens the DM4 image and returns the name of the image, the image itself, and the pixel size.
+    If "dtype" is given (for instance 'float32'), the image is converted to that type."""
     fileDM4 = dm.dmReader(filepath)  # Imports the dm4 image as a dictionary.
     filename = fileDM4['filename']  # Gets the name of the image.
     filename = filename.split('.')[0]  # Removes the '.dm4' extension from the name of the image.
-    img = fileDM4['data']  # Gets the image itself as a float32 Numpy array.
+    img = convert_image(fileDM4['data'], dtype)  # Gets the image itself as a float32 Numpy array.
     pixel_size = fileDM4['pixelSize'][0]  # Gets the pixel size in nm.
     return filename, img, pixel_size
 
 
-def img_prep(img, block_size=301, erosions=1, dilations=5, small_object_removal=2000, small_holes_removal=500):
+def open_mrc(filepath, dtype=None):
+    """This function opens an MRC file and returns the name of the image, the image itself, and the pixel size in nm.
+    The pixel data are copied into memory and the file is closed. If "dtype" is given, the image is converted to that type."""
+    with open_image(filepath, mmap=True) as (filename, img, pixel_size):
+        img = np.array(img, dtype=dtype)  # Copies the image, so that it outlives the file.
+    return filename, img, pixel_size
+
+
+def is_mrc(filepath):
+    return os.path.splitext(filepath)[1].lower() in ('.mrc', '.mrcs')
+
+
+def image_name(filepath):
+    """This function returns the name of an image, that is its file name without the folder and the extension."""
+    return os.path.splitext(os.path.basename(filepath))[0]
+
+
+def convert_image(img, dtype=None):
+    """This function converts the image to "dtype" (for instance 'float32' to downcast float64 data). The image is returned
+    unchanged if "dtype" is None or if it already has that type."""
+    if dtype is None or img.dtype == np.dtype(dtype):
+        return img
+    return img.astype(dtype)
+
+
+def read_header(filepath):
+    """This function reads the name, the shape, the type and the pixel size in nm of an MRC or DM3/DM4 image without reading its
+    pixel data. The output is an ImageHeader."""
+    if is_mrc(filepath):
+        import mrcfile
+        with mrcfile.open(filepath, header_only=True) as mrc:
+            header = mrc.header
+            shape = (int(header.ny), int(header.nx)) if header.nz == 1 else (int(header.nz), int(header.ny), int(header.nx))
+            dtype = mrcfile.utils.data_dtype_from_header(header)
+            return ImageHeader(image_name(filepath), shape, dtype, float(mrc.voxel_size.x) * 0.1)
+    with dm.fileDM(filepath, on_memory=False) as fileDM4:
+        shape, dtype, pixel_size = dm_dataset_info(fileDM4)
+        return ImageHeader(image_name(filepath), shape, dtype, pixel_size)
+
+
+def dm_dataset_info(fileDM4, index=0):
+    """This function returns the shape, the type and the pixel size in nm of the dataset "index" of an open ncempy fileDM, from the
+    tags parsed when the file was opened, without reading its pixel data (getDataset reads all the pixels, even with on_memory=False).
+    Like getDataset, it skips the thumbnail that most DM files start with and gives the dimensions in C order."""
+    i = index if fileDM4.numObjects == 1 else index + 1
+    sizes = (fileDM4.zSize2[i], fileDM4.zSize[i], fileDM4.ySize[i], fileDM4.xSize[i])
+    if fileDM4.zSize[i] == 1:
+        shape = sizes[2:]  # 2D images (and spectra).
+    elif fileDM4.zSize2[i] > 1:
+        shape = sizes
+    else:
+        shape = sizes[1:]
+    first_scale = sum(fileDM4.dataShape[:i])  # The scales of all the datasets are in one list, with the x dimension first.
+    pixel_size = fileDM4.scale[first_scale + fileDM4.dataShape[i] - 1]
+    return tuple(int(size) for size in shape), np.dtype(fileDM4._DM2NPDataType(fileDM4.dataType[i])), float(pixel_size)
+
+
+@contextmanager
+def open_image(filepath, mmap=True, dtype=None):
+    """This function opens an MRC or DM3/DM4 image as a context manager that gives the name of the image, the image itself and
+    the pixel size in nm, and closes the file when the block ends. With "mmap", the pixel data are memory-mapped and only read
+    from disk when they are used, so the image is only valid inside the block. If "dtype" is given, an in-memory copy converted
+    to that type is given instead."""
+    if is_mrc(filepath):
+        import mrcfile
+        with (mrcfile.mmap if mmap else mrcfile.open)(filepath, mode='r') as mrc:
+            yield image_name(filepath), convert_image(mrc.data, dtype), float(mrc.voxel_size.x) * 0.1
+    else:
+        with dm.fileDM(filepath, on_memory=not mmap) as fileDM4:
+            if mmap:
+                shape, _, pixel_size = dm_dataset_info(fileDM4)
+                img = fileDM4.getMemmap(0).reshape(shape)  # Only the tags have been read, the pixels are read when used.
+            else:
+                dataset = fileDM4.getDataset(0)
+                img, pixel_size = dataset['data'], dataset['pixelSize'][0]
+            yield image_name(filepath), convert_image(img, dtype), pixel_size
+
+
+def iter_frames(filepath, dtype=None):
+    """This function is a generator that reads the frames of an MRC or DM3/DM4 image (or frame stack) one at a time from the
+    memory-mapped file. Each frame is an in-memory copy, converted to "dtype" if it is given. A single image gives one frame."""
+    with open_image(filepath, mmap=True) as (filename, img, pixel_size):
+        frames = img[np.newaxis] if img.ndim == 2 else img
+        for frame in frames:
+            yield np.array(frame, dtype=dtype)
+
+
+def threshold_integral(img, block_size):
+    """This function computes the local mean threshold of the image with a summed-area table (integral image), so that each pixel
+    costs the same whatever the block size. The borders are reflected like in filters.threshold_local."""
+    r = block_size // 2
+    padded = np.pad(img.astype(np.float64), r, mode='symmetric')
+    sat = np.zeros((padded.shape[0] + 1, padded.shape[1] + 1))
+    np.cumsum(padded, axis=0, out=sat[1:, 1:])
+    np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+    rows, cols = img.shape
+    window_sum = (
+        sat[block_size:block_size + rows, block_size:block_size + cols]
+        - sat[:rows, block_size:block_size + cols]
+        - sat[block_size:block_size + rows, :cols]
+        + sat[:rows, :cols]
+    )
+    return window_sum / (block_size * block_size)
+
+
+def threshold_downsampled(img, block_size, factor=4):
+    """This function approximates the Gaussian local threshold by computing it on the image downsampled by "factor" and then
+    upsampling the threshold back to the size of the image."""
+    small = transform.downscale_local_mean(img, (factor, factor))
+    small_block_size = max(3, (block_size // factor) | 1)  # The block size has to be odd.
+    small_thresh = filters.threshold_local(small, small_block_size, offset=0)
+    return transform.resize(small_thresh, img.shape, order=1, preserve_range=True)
+
+
+# Backends of the adaptive thresholding. "gaussian" is the reference one, "integral" is a local mean in O(1) per pixel, and
+# "downsampled" is a fast approximation of "gaussian".
+THRESHOLD_METHODS = {
+    'gaussian': lambda img, block_size: filters.threshold_local(img, block_size, offset=0),
+    'integral': threshold_integral,
+    'downsampled': threshold_downsampled,
+}
+
+
+def compare_threshold_methods(img, block_size=301):
+    """This function times each thresholding backend on the image and measures how its mask agrees with the "gaussian" one.
+    The output is a dictionary with, for each method, the time in seconds, the fraction of pixels equal to the reference mask,
+    and the intersection over union of the two masks."""
+    masks = {}
+    comparison = {}
+    for method, threshold in THRESHOLD_METHODS.items():
+        start = time.perf_counter()
+        masks[method] = img > threshold(img, block_size)
+        comparison[method] = {'seconds': time.perf_counter() - start}
+    for method, mask in masks.items():
+        union = np.count_nonzero(mask | masks['gaussian'])
+        comparison[method]['agreement'] = float(np.mean(mask == masks['gaussian']))
+        comparison[method]['iou'] = np.count_nonzero(mask & masks['gaussian']) / union if union > 0 else 1.0
+    return comparison
+
+
+def remove_small_objects_inplace(binary_img, min_size, block_rows=256):
+    """This function removes the objects smaller than "min_size" pixels from the binary image, in place, like
+    morphology.remove_small_objects with its default connectivity. The objects are labelled as int32 and their sizes are counted
+    and applied "block_rows" rows at a time, so the only full-size image allocated is the int32 labels: remove_small_objects also
+    makes a copy of the image, an int64 copy of the labels for np.bincount and a boolean mask of the pixels to remove."""
+    labels = np.empty(binary_img.shape, dtype=np.int32)
+    count = ndi.label(binary_img, ndi.generate_binary_structure(binary_img.ndim, 1), output=labels)
+    sizes = np.zeros(count + 1, dtype=np.intp)
+    for start in range(0, labels.shape[0], block_rows):
+        sizes += np.bincount(labels[start:start + block_rows].ravel(), minlength=count + 1)
+    too_small = sizes < min_size
+    too_small[0] = False  # The background.
+    for start in range(0, labels.shape[0], block_rows):
+        block = binary_img[start:start + block_rows]
+        block[too_small[labels[start:start + block_rows]]] = False
+    return binary_img
+
+
+def erode_dilate(binary_img, erosions=1, dilations=5, small_object_removal=2000):
+    """This function erodes the binary image a number of times, removes the small objects, and dilates the image a number of times.
+    Repeated erosions (or dilations) with the default cross-shaped footprint are done as one scipy operation with iterations=n,
+    which gives the same result as n separate calls but only revisits the pixels that changed and doesn't allocate a new image
+    per iteration. The erosions write into one buffer, the small objects are removed from it in place, and the dilations write
+    back into "binary_img", which is overwritten."""
+    cross = ndi.generate_binary_structure(binary_img.ndim, 1)  # Same footprint as morphology.binary_erosion/binary_dilation.
+    buffer = np.empty_like(binary_img, dtype=bool)
+    if erosions > 0:
+        ndi.binary_erosion(binary_img, structure=cross, iterations=erosions, border_value=True, output=buffer)
+    else:
+        buffer[...] = binary_img
+    remove_small_objects_inplace(buffer, small_object_removal)  # Removes small objects.
+    if dilations > 0:
+        ndi.binary_dilation(buffer, structure=cross, iterations=dilations, output=binary_img)
+    else:
+        binary_img[...] = buffer
+    return binary_img
+
+
+def erode_dilate_loop(binary_img, erosions=1, dilations=5, small_object_removal=2000):
+    """This function is the reference version of erode_dilate, with one skimage call (and one new image) per erosion and dilation."""
+    for i in range(erosions):  # Erodes the image a number of times.
+        binary_img = morphology.binary_erosion(binary_img)
+    binary_img = morphology.remove_small_objects(binary_img, small_object_removal)  # Removes small objects.
+    for i in range(dilations):  # Dilates the image a number of times.
+        binary_img = morphology.binary_dilation(binary_img)
+    return binary_img
+
+
+def count_allocations(function, *args, min_bytes=1, **kwargs):
+    """This function runs "function" and counts the arrays (or other memory blocks) of at least "min_bytes" that it allocates.
+    The memory traced by tracemalloc is compared before and after every Python and C call made during the run (with sys.setprofile),
+    so a block allocated and freed within a single C call is not counted. The output is the output of the function and the count."""
+    def large_blocks():
+        snapshot = tracemalloc.take_snapshot()
+        return Counter((trace.size, trace.traceback) for trace in snapshot.traces if trace.size >= min_bytes)
+
+    blocks = Counter()
+    allocations = 0
+
+    def profile(frame, event, arg):
+        nonlocal blocks, allocations
+        current = large_blocks()
+        allocations += sum((current - blocks).values())
+        blocks = current
+
+    tracemalloc.start()
+    sys.setprofile(profile)
+    try:
+        output = function(*args, **kwargs)
+    finally:
+        sys.setprofile(None)
+        tracemalloc.stop()
+    return output, allocations
+
+
+def compare_morphology(binary_img, erosions=1, dilations=5, small_object_removal=2000):
+    """This function runs erode_dilate and its reference loop version on the binary image and reports what the optimized version saves.
+    Each version is run three times on a copy of the image: once timed, once under tracemalloc for its peak memory in bytes, and once
+    with count_allocations for the number of full-size images it allocates (a full-size boolean image or bigger). The output is a
+    dictionary with these measures for each version, what the optimized version saves, and whether both versions give the same image."""
+    comparison = {}
+    outputs = {}
+    for version, stage in (('loop', erode_dilate_loop), ('optimized', erode_dilate)):
+        binary_copy = binary_img.copy()
+        start = time.perf_counter()
+        outputs[version] = stage(binary_copy, erosions, dilations, small_object_removal)
+        seconds = time.perf_counter() - start
+
+        binary_copy = binary_img.copy()
+        tracemalloc.start()
+        stage(binary_copy, erosions, dilations, small_object_removal)
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        _, allocations = count_allocations(
+            stage, binary_img.copy(), erosions, dilations, small_object_removal, min_bytes=binary_img.size
+        )
+        comparison[version] = {'seconds': seconds, 'peak_bytes': peak_bytes, 'allocations': allocations}
+    for measure_name in ('seconds', 'peak_bytes', 'allocations'):
+        comparison[measure_name + '_saved'] = comparison['loop'][measure_name] - comparison['optimized'][measure_name]
+    comparison['same_result'] = bool(np.array_equal(outputs['loop'], outputs['optimized']))
+    return comparison
+
+
+def img_prep(img, block_size=301, erosions=1, dilations=5, small_object_removal=2000, small_holes_removal=500,
+             threshold_method='gaussian'):
     """This function performs an adaptive thresholding, followed by erosions, followed by small objects removal, followed by dilations,
-    followed by small holes removal. The output is the processed image"""
-    thresh = filters.threshold_local(
-        img, block_size, offset=0
+    followed by small holes removal. The output is the processed image.
+    "threshold_method" is one of THRESHOLD_METHODS: "gaussian" (the default), "integral" or "downsampled"."""
+    thresh = THRESHOLD_METHODS[threshold_method](
+        img, block_size
     )  # Computes a threshold mask image based on the local pixel neighborhood. Also known as adaptive or dynamic thresholding.
     binary_local = img > thresh  # Uses the threshold to obtain a binary image.
-    for i in range(erosions):  # Erodes the image a number of times.
-        binary_local = morphology.binary_erosion(binary_local)
-    binary_local = morphology.remove_small_objects(
-        binary_local, small_object_removal)  # Removes small objects.
-    for i in range(dilations):  # Dilates the image a number of times.
-        binary_local = morphology.binary_dilation(binary_local)
+    binary_local = erode_dilate(
+        binary_local, erosions, dilations, small_object_removal
+    )  # Erodes the image, removes the small objects and dilates the image.
     binary_local = morphology.remove_small_holes(
         binary_local,
         small_holes_removal)  # Removes small holes in the objects.
@@ -46,11 +375,14 @@ def watershedding(binary_img, seed_threshold=0.2):
     """This function watersheds the objects to separate them. It's followed by the removal of small objects."""
     distance = ndi.distance_transform_edt(
         binary_img)  # Applies a distance transform to the image.
-    local_maxi = np.copy(
-        distance
-    )  # We make a copy of our image so as not to destroy the original.
-    local_maxi = local_maxi > (
-        np.max(local_maxi) * seed_threshold
+    return watershed_distance(binary_img, distance, seed_threshold)
+
+
+def watershed_distance(binary_img, distance, seed_threshold=0.2):
+    """This function does the same as watershedding from the distance transform of the binary image, so that several seed
+    thresholds can be tried on the same distance transform."""
+    local_maxi = distance > (
+        np.max(distance) * seed_threshold
     )  # We take a threshold based on the size of the objects. The middle 20% remains as a seed for each region.
     markers = ndi.label(local_maxi)[0]
     labels = segmentation.watershed(
@@ -61,22 +393,420 @@ def watershedding(binary_img, seed_threshold=0.2):
     return labels
 
 
-def plotfig(labels, region_properties, img, filename, out_dpi = 600):
-    """This function takes the labelled image, the properties of the labels, and the name of the image and then plots (and saves) the figure."""
-    fig, ax = plt.subplots(1, 2, figsize=(15, 8))
-    ax[0].imshow(
-        color.label2rgb(
-            labels,
-            bg_label=0,
-            colors=[
-                'red', 'violet', 'orange', 'green', 'blue',
-                'magenta', 'purple', 'crimson', 'lime', 'maroon',
-                'mediumvioletred', 'goldenrod', 'darkgreen',
-                'fuchsia', 'cornflowerblue', 'navy', 'hotpink',
-                'grey', 'chocolate', 'peru'
-            ]
+def padded_slices(slices, shape, padding=1):
+    """This function enlarges the slices of a bounding box by "padding" pixels on every side, within an image of shape "shape"."""
+    return tuple(slice(max(s.start - padding, 0), min(s.stop + padding, size)) for s, size in zip(slices, shape))
+
+
+def watershedding_components(binary_img, seed_threshold=0.2, per_component=False, max_workers=4):
+    """This function does the same as watershedding, component by component. The connected components of the binary image are
+    found first, and everything else is done within the bounding box of each component, in parallel with "max_workers" threads:
+    the distance transform, the seeds, the watershed, and the removal of the objects that touch the edges of the image. The only
+    full-size arrays are the components and the output labels (int32), plus the distances of the object pixels as float32, while
+    watershedding makes a float64 distance transform and several full-size temporaries.
+    The seeds are the pixels whose distance is above "seed_threshold" times the largest distance of the image, as in
+    watershedding, and are numbered in the order of their first pixel on the whole image, as ndi.label numbers them, which gives
+    the same labels with the same numbers, except where several seeds of a component meet on a plateau of the distance transform:
+    the watershed then breaks the ties in its own flooding order, which isn't the same in a bounding box as on the whole image. The
+    separated nanorods of a micrograph rarely have such plateaus. If "per_component" is True, the largest distance of each component is used instead,
+    so a single big blob doesn't dictate the seeds of every other object."""
+    components, n_components = ndi.label(binary_img, structure=np.ones((3, 3)))  # Objects touching diagonally are kept together.
+    boxes = [padded_slices(box, binary_img.shape) for box in ndi.find_objects(components)]
+    height, width = binary_img.shape
+
+    def component_distance(k):
+        mask = components[boxes[k]] == k + 1
+        # The other components in the box count as background, which gives the same distances since they never touch this one.
+        return ndi.distance_transform_edt(mask)[mask].astype(np.float32)
+
+    def component_seeds(k):
+        mask = components[boxes[k]] == k + 1
+        distance = np.zeros(mask.shape, dtype=np.float32)
+        distance[mask] = distances[k]
+        seeds = ndi.label(distance > seed_levels[k])[0]
+        return mask, distance, seeds
+
+    def first_seed_pixels(k):
+        """This function returns the position on the whole image of the first pixel of each seed of the component."""
+        seeds = component_seeds(k)[2]
+        values, first = np.unique(seeds, return_index=True)
+        rows, cols = np.unravel_index(first[values > 0], seeds.shape)
+        return (rows + boxes[k][0].start) * width + cols + boxes[k][1].start
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        distances = list(executor.map(component_distance, range(n_components)))
+        max_distances = np.array([i.max() for i in distances], dtype=np.float32)
+        if per_component:
+            seed_levels = max_distances * np.float32(seed_threshold)
+        else:
+            seed_levels = np.full(n_components, max_distances.max(initial=0) * np.float32(seed_threshold), dtype=np.float32)
+
+        # Numbers the seeds of all the components in the order of their first pixel, like ndi.label on the whole image would.
+        first_pixels = list(executor.map(first_seed_pixels, range(n_components)))
+        offsets = np.cumsum([0] + [len(i) for i in first_pixels])
+        numbers = np.empty(offsets[-1], dtype=np.int32)
+        numbers[np.argsort(np.concatenate(first_pixels + [np.zeros(0, dtype=np.intp)]), kind='stable')] = np.arange(1, offsets[-1] + 1)
+        labels = np.zeros(binary_img.shape, dtype=np.int32)
+
+        def component_watershed(k):
+            box = boxes[k]
+            mask, distance, seeds = component_seeds(k)
+            component_labels = segmentation.watershed(-distance, seeds, mask=mask)
+            lut = np.concatenate([[0], numbers[offsets[k]:offsets[k + 1]]]).astype(np.int32)
+            # Removes the objects that touch the edges of the image, like segmentation.clear_border.
+            edges = np.zeros(mask.shape, dtype=bool)
+            edges[0, :] |= box[0].start == 0
+            edges[-1, :] |= box[0].stop == height
+            edges[:, 0] |= box[1].start == 0
+            edges[:, -1] |= box[1].stop == width
+            lut[component_labels[edges]] = 0
+            np.copyto(labels[box], lut[component_labels], where=mask)
+
+        for _ in executor.map(component_watershed, range(n_components)):
+            pass
+
+    return labels
+
+
+# Ways of watershedding the binary images: on the whole image at once, or component by component (see watershedding_components).
+WATERSHED_METHODS = {
+    'full': watershedding,
+    'components': watershedding_components,
+}
+
+
+# Approximate number of bytes that segmenting one pixel of a tile takes (image, threshold and distance transform as float64,
+# masks, markers and labels). It is used to choose the size of the tiles from a memory budget.
+TILE_BYTES_PER_PIXEL = 50
+
+
+def tile_size_for_budget(memory_budget, overlap, max_workers):
+    """This function returns the largest tile size such that "max_workers" padded tiles fit in "memory_budget" bytes."""
+    padded_size = int(np.sqrt(memory_budget / (TILE_BYTES_PER_PIXEL * max_workers)))
+    return max(256, padded_size - 2 * overlap)
+
+
+def scratch_array(shape, dtype):
+    """This function returns a zeroed array backed by an unnamed temporary file rather than by memory, for the full-size arrays of
+    the images that don't fit in the memory. The file is deleted when the array is."""
+    return np.memmap(tempfile.TemporaryFile(), dtype=dtype, mode='w+', shape=shape)
+
+
+def image_tiles(shape, tile_size, overlap):
+    """This function splits an image of the given shape into tiles. Each tile is a (core, padded) pair of slice tuples, where
+    the padded slices extend the core by "overlap" pixels on each side, clipped to the image."""
+    tiles = []
+    for row in range(0, shape[0], tile_size):
+        for col in range(0, shape[1], tile_size):
+            core = (slice(row, min(row + tile_size, shape[0])), slice(col, min(col + tile_size, shape[1])))
+            padded = tuple(
+                slice(max(s.start - overlap, 0), min(s.stop + overlap, size)) for s, size in zip(core, shape)
+            )
+            tiles.append((core, padded))
+    return tiles
+
+
+def map_bounded(executor, function, items, max_pending):
+    """This function is executor.map with at most "max_pending" items in flight, so that the results waiting to be consumed
+    don't pile up in memory. The results are yielded in the order of the items."""
+    pending = []
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= max_pending:
+            yield pending.pop(0).result()
+    for future in pending:
+        yield future.result()
+
+
+def segment_tiled(img, tile_size=2048, overlap=None, memory_budget=None, max_workers=4, seed_threshold=0.2, out=None,
+                  **prep_parameters):
+    """This function does the same as img_prep followed by watershedding, tile by tile, for images too big to be segmented at once.
+    The tiles are processed in parallel with "max_workers" threads, and each one is padded by "overlap" pixels of context (twice
+    the block size by default). The overlap has to be larger than the biggest object and than the reach of the thresholding,
+    otherwise objects crossing the seams may be cut. "prep_parameters" are passed to img_prep, and "out" can be an array (for
+    instance a numpy.memmap) in which the labels are written.
+    If "memory_budget" (in bytes) is given, the full-size mask and labels (unless "out" is given) are counted in it: if they take
+    more than half of it, they are written to temporary files (see scratch_array) instead, so the labels returned are then a
+    numpy.memmap. The tile size is then chosen so that the tiles being processed fit in the rest of the budget.
+    It works in two passes. First the binary mask of each tile is computed and written into a full-size boolean mask, along with the
+    largest distance to the background, so that the seeds use the same threshold as watershedding on the whole image. Then each
+    padded tile of the mask is watershedded and the objects that touch its edges are cleared, which removes the objects at the
+    true image edge like segmentation.clear_border does and the objects cut by the padding. An object is only kept by the tile
+    whose core contains the top-left corner of its bounding box, so an object crossing a seam is counted once."""
+    block_size = prep_parameters.get('block_size', 301)
+    if overlap is None:
+        overlap = 2 * block_size
+    new_array = np.zeros
+    if memory_budget is not None:
+        full_size_bytes = img.size * (np.dtype(bool).itemsize + (np.dtype(np.int32).itemsize if out is None else 0))
+        if full_size_bytes > memory_budget / 2:
+            new_array = scratch_array  # The full-size arrays don't fit in the budget along with the tiles.
+        else:
+            memory_budget -= full_size_bytes
+        tile_size = tile_size_for_budget(memory_budget, overlap, max_workers)
+    tiles = image_tiles(img.shape, tile_size, overlap)
+    mask = new_array(img.shape, dtype=bool)
+    labels = new_array(img.shape, dtype=np.int32) if out is None else out
+
+    def prep_tile(tile):
+        core, padded = tile
+        binary = img_prep(np.asarray(img[padded]), **prep_parameters)
+        inner = tuple(slice(c.start - p.start, c.stop - p.start) for c, p in zip(core, padded))
+        distance = ndi.distance_transform_edt(binary)
+        return binary[inner], distance[inner].max(initial=0)
+
+    def watershed_tile(tile):
+        core, padded = tile
+        binary = mask[padded]
+        distance = ndi.distance_transform_edt(binary)
+        markers = ndi.label(distance > max_distance * seed_threshold)[0]
+        tile_labels = segmentation.clear_border(segmentation.watershed(-distance, markers, mask=binary))
+        # Keeps the objects whose bounding box starts in the core of the tile.
+        props = measure.regionprops_table(tile_labels, properties=('label', 'bbox'))
+        owned = (
+            (props['bbox-0'] + padded[0].start >= core[0].start) & (props['bbox-0'] + padded[0].start < core[0].stop)
+            & (props['bbox-1'] + padded[1].start >= core[1].start) & (props['bbox-1'] + padded[1].start < core[1].stop)
         )
-    )
+        lut = np.zeros(int(tile_labels.max(initial=0)) + 1, dtype=np.int32)
+        lut[props['label'][owned]] = np.arange(1, np.count_nonzero(owned) + 1)
+        return lut[tile_labels], int(np.count_nonzero(owned))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        max_distance = 0
+        for (core, padded), (binary, tile_max_distance) in zip(
+            tiles, map_bounded(executor, prep_tile, tiles, 2 * max_workers)
+        ):
+            mask[core] = binary
+            max_distance = max(max_distance, tile_max_distance)
+
+        offset = 0
+        for (core, padded), (tile_labels, count) in zip(
+            tiles, map_bounded(executor, watershed_tile, tiles, 2 * max_workers)
+        ):
+            region = labels[padded]
+            owned = tile_labels > 0
+            region[owned] = tile_labels[owned] + offset
+            offset += count
+
+    return labels
+
+
+class StageCache:
+    """This class is an on-disk cache for the outputs of the expensive stages of the pipeline (img_prep and watershedding).
+    Each output is saved as a .npy file named after a hash of the stage input pixels and the stage parameters, so it is reused
+    whenever the same image is processed with the same parameters, whatever the downstream filters. When the cache grows over
+    "max_bytes", the least recently used outputs are deleted."""
+
+    # Age in seconds after which a temporary file is assumed to be left by a writer that crashed, and is deleted.
+    TEMP_LIFETIME = 3600
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, stage, array, parameters):
+        """This function returns the key of a stage output: a hash of the input pixels, their shape and type, and the parameters."""
+        array = np.ascontiguousarray(array)
+        digest = hashlib.sha1()
+        digest.update(json.dumps([stage, str(array.dtype), array.shape, parameters], sort_keys=True).encode())
+        digest.update(array.data)
+        return stage + '-' + digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def get(self, key):
+        """This function returns the cached output for "key", or None if it isn't cached."""
+        path = self.path(key)
+        try:
+            output = np.load(path)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(path)  # Marks the output as recently used.
+        except OSError:
+            pass  # Another process evicted it in the meantime, which doesn't matter since it is already loaded.
+        return output
+
+    def put(self, key, output):
+        """This function saves an output in the cache and then deletes the least recently used outputs if the cache is too big."""
+        path = self.path(key)
+        temp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_path, 'wb') as temp_file:
+            np.save(temp_file, output)
+        os.replace(temp_path, path)  # Other sessions never see a half written file.
+        self.evict()
+
+    def evict(self):
+        """This function deletes the least recently used outputs until the cache fits in "max_bytes", and the temporary files
+        left by the writers that crashed. The cache may be shared by several processes, so the files can disappear at any time."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            try:
+                stat = entry.stat()
+                if entry.name.endswith('.npy'):
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                elif entry.name.endswith('.tmp') and stat.st_mtime < time.time() - self.TEMP_LIFETIME:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def run(self, stage, array, **parameters):
+        """This function returns the output of "stage" for "array" and "parameters", from the cache if possible."""
+        key = self.key(stage.__name__, array, parameters)
+        output = self.get(key)
+        if output is None:
+            output = stage(array, **parameters)
+            self.put(key, output)
+        return output
+
+
+def cached_img_prep(cache, img, **parameters):
+    """This function runs img_prep through a StageCache. The parameters are the ones of img_prep."""
+    return cache.run(img_prep, img, **parameters)
+
+
+def cached_watershedding(cache, binary_img, **parameters):
+    """This function runs watershedding through a StageCache. The parameters are the ones of watershedding."""
+    return cache.run(watershedding, binary_img, **parameters)
+
+
+# Columns of the table of StageProfiler, one row per stage run.
+PROFILE_FIELDS = ['image', 'stage', 'start', 'wall_seconds', 'cpu_seconds', 'peak_bytes', 'objects']
+
+
+def count_objects(output):
+    """This function returns the number of objects in the output of a stage: the highest label of a labelled image (the number of
+    labels once they are reordered) or the number of rows of a table of measure_labels. It returns None for any other output,
+    binary masks included, since counting their objects would cost a labelling."""
+    if isinstance(output, dict) and 'label' in output:
+        return len(output['label'])
+    if isinstance(output, np.ndarray) and output.dtype.kind in 'iu':
+        return int(output.max()) if output.size > 0 else 0
+    return None
+
+
+def peak_rss_bytes():
+    """This function returns the highest resident memory of this process so far, in bytes, or None where it isn't available."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # ru_maxrss is in bytes on macOS and in kB on Linux.
+
+
+class StageProfiler:
+    """This class records the wall time, CPU time, peak memory and number of objects of every stage run on every image.
+    The CPU time is that of the whole process, background threads included. By default the peak memory is the highest resident
+    memory of the process at the end of the stage, which costs nothing to read; with memory='tracemalloc' it is the peak of the
+    memory allocated during the stage itself, which is more precise but slows down the allocations, and with memory=None it is
+    not recorded. The records are kept in memory (see table and summary) and, if "trace_path" is given, appended to that file as
+    JSON lines as soon as each stage ends. Stages must not be nested when memory='tracemalloc'."""
+
+    def __init__(self, memory='rss', trace_path=None):
+        if memory not in ('rss', 'tracemalloc', None):
+            raise ValueError('Unknown memory mode: ' + str(memory))
+        self.memory = memory
+        self.records = []
+        self.lock = threading.Lock()
+        self.trace_file = open(trace_path, 'a') if trace_path is not None else None
+        if memory == 'tracemalloc' and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name, image=None):
+        """This function records the code run in a with block as the stage "name" of "image". The block can set the "objects"
+        entry of the record it receives."""
+        record = {'image': image, 'stage': name, 'start': time.time(), 'objects': None}
+        if self.memory == 'tracemalloc':
+            tracemalloc.reset_peak()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        yield record
+        record['wall_seconds'] = time.perf_counter() - wall_start
+        record['cpu_seconds'] = time.process_time() - cpu_start
+        if self.memory == 'tracemalloc':
+            record['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+        elif self.memory == 'rss':
+            record['peak_bytes'] = peak_rss_bytes()
+        else:
+            record['peak_bytes'] = None
+        self.add([record])
+
+    def run(self, stage, *args, image=None, **kwargs):
+        """This function runs stage(*args, **kwargs), records it under the name of the function and returns its output."""
+        with self.stage(stage.__name__, image) as record:
+            output = stage(*args, **kwargs)
+            record['objects'] = count_objects(output)
+        return output
+
+    def add(self, records):
+        """This function adds records made elsewhere, for example by a worker process."""
+        with self.lock:
+            self.records.extend(records)
+            if self.trace_file is not None:
+                for record in records:
+                    self.trace_file.write(json.dumps(record) + '\n')
+                self.trace_file.flush()
+
+    def table(self):
+        """This function returns the records as a dictionary of columns (see PROFILE_FIELDS), ready for pandas or for R.
+        Missing numbers are NaN and missing image names are empty, so that every column converts to an R vector."""
+        with self.lock:
+            records = list(self.records)
+        columns = {field: [record.get(field) for record in records] for field in PROFILE_FIELDS}
+        columns['image'] = ['' if image is None else image for image in columns['image']]
+        for field in PROFILE_FIELDS[2:]:
+            columns[field] = [np.nan if value is None else value for value in columns[field]]
+        return columns
+
+    def summary(self):
+        """This function returns, for each stage, its number of runs, its total wall and CPU times, and its highest peak memory,
+        as a dictionary of columns with the slowest stage first."""
+        stages = {}
+        with self.lock:
+            for record in self.records:
+                runs, wall, cpu, peak = stages.get(record['stage'], (0, 0.0, 0.0, None))
+                if record['peak_bytes'] is not None:
+                    peak = max(peak or 0, record['peak_bytes'])
+                stages[record['stage']] = (runs + 1, wall + record['wall_seconds'], cpu + record['cpu_seconds'], peak)
+        order = sorted(stages, key=lambda stage: -stages[stage][1])
+        return {
+            'stage': order,
+            'runs': [stages[stage][0] for stage in order],
+            'wall_seconds': [stages[stage][1] for stage in order],
+            'cpu_seconds': [stages[stage][2] for stage in order],
+            'peak_bytes': [np.nan if stages[stage][3] is None else stages[stage][3] for stage in order],
+        }
+
+    def write_trace(self, path):
+        """This function writes all the records to "path" as JSON lines, one per stage run."""
+        with self.lock, open(path, 'w') as trace_file:
+            for record in self.records:
+                trace_file.write(json.dumps(record) + '\n')
+
+    def close(self):
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
+
+
+def plotfig(labels, region_properties, img, filename, out_dpi = 600):
+    """This function takes the labelled image, the properties of the labels, and the name of the image and then plots (and saves) the figure.
+    It doesn't use pyplot, so it can run in a background thread."""
+    from matplotlib.figure import Figure
+    fig = Figure(figsize=(15, 8))
+    ax = fig.subplots(1, 2)
+    ax[0].imshow(color.label2rgb(labels, bg_label=0, colors=LABEL_COLORS))
     ax[0].set_title('Selected objects', fontsize=16)
     for i in region_properties:
         ax[0].text(i.centroid[1], i.centroid[0], i.label, color='white')
@@ -84,70 +814,125 @@ def plotfig(labels, region_properties, img, filename, out_dpi = 600):
     ax[1].contour(labels, colors='r', linewidths=0.8)
     ax[1].set_title('Original', fontsize=16)
 
-    plt.tight_layout()
-    plt.savefig(filename + '.png', dpi=out_dpi)
-    plt.close()
+    fig.tight_layout()
+    fig.savefig(filename + '.png', dpi=out_dpi)
+
+
+def save_borderless(fig, ax, path, out_dpi):
+    """This function saves a figure of a single image without axes or margins."""
+    from matplotlib.ticker import NullLocator
+    ax.set_axis_off()
+    fig.subplots_adjust(top=1, bottom=0, right=1, left=0, hspace=0, wspace=0)
+    ax.margins(0, 0)
+    ax.xaxis.set_major_locator(NullLocator())
+    ax.yaxis.set_major_locator(NullLocator())
+    fig.savefig(path, dpi=out_dpi, bbox_inches='tight', pad_inches=0)
 
 
 def plotfig_separate(labels, region_properties, img, filename, out_dpi = 600):
-    """This function takes the labelled image, the properties of the labels, and the name of the image and then plots (and saves) the figure."""
-
-    fig, ax = plt.subplots()
-    ax.imshow(
-        color.label2rgb(
-            labels,
-            bg_label=0,
-            colors=[
-                'red', 'violet', 'orange', 'green', 'blue',
-                'magenta', 'purple', 'crimson', 'lime', 'maroon',
-                'mediumvioletred', 'goldenrod', 'darkgreen',
-                'fuchsia', 'cornflowerblue', 'navy', 'hotpink',
-                'grey', 'chocolate', 'peru'
-            ]
-        )
-    )
+    """This function takes the labelled image, the properties of the labels, and the name of the image and then plots (and saves) the figure.
+    It doesn't use pyplot, so it can run in a background thread."""
+    from matplotlib.figure import Figure
+    fig = Figure()
+    ax = fig.subplots()
+    ax.imshow(color.label2rgb(labels, bg_label=0, colors=LABEL_COLORS))
     for i in region_properties:
         ax.text(i.centroid[1], i.centroid[0], i.label, color='white')
+    save_borderless(fig, ax, filename + '_processed.png', out_dpi)
 
-    plt.gca().set_axis_off()
-    plt.subplots_adjust(top=1, bottom=0, right=1, left=0, hspace=0, wspace=0)
-    plt.margins(0, 0)
-    plt.gca().xaxis.set_major_locator(plt.NullLocator())
-    plt.gca().yaxis.set_major_locator(plt.NullLocator())
-    plt.savefig(filename + '_processed.png', dpi=out_dpi, bbox_inches='tight', pad_inches=0)
-    plt.close()
-
-    fig, ax = plt.subplots()
+    fig = Figure()
+    ax = fig.subplots()
     ax.imshow(img, cmap='Greys_r')
     ax.contour(labels, colors='r', linewidths=0.8)
+    save_borderless(fig, ax, filename + '_raw.png', out_dpi)
+
+
+def preview_images(labels, img, max_size=1024):
+    """This function makes small RGB thumbnails of the labelled image and of the original image with the outlines of the labels,
+    directly as uint8 arrays. The images are downsampled so that their largest side is at most "max_size", the labels are coloured
+    through a lookup table (cycling through LABEL_COLORS like color.label2rgb) and the outlines come from segmentation.find_boundaries.
+    The output is a (processed, raw) pair of arrays."""
+    from matplotlib.colors import to_rgb
+    step = max(1, int(np.ceil(max(labels.shape) / max_size)))
+    small_labels = labels[::step, ::step]
+    small_img = np.asarray(img[::step, ::step], dtype=np.float32)
+
+    lut = np.zeros((int(labels.max(initial=0)) + 1, 3), dtype=np.uint8)
+    palette = (np.array([to_rgb(name) for name in LABEL_COLORS]) * 255).astype(np.uint8)
+    lut[1:] = palette[np.arange(len(lut) - 1) % len(palette)]
+    processed = lut[small_labels]
+
+    low, high = np.percentile(small_img, (0.5, 99.5))
+    grey = (np.clip((small_img - low) / max(high - low, np.finfo(np.float32).eps), 0, 1) * 255).astype(np.uint8)
+    raw = np.repeat(grey[..., np.newaxis], 3, axis=-1)
+    raw[segmentation.find_boundaries(small_labels, mode='inner')] = (255, 0, 0)
+    return processed, raw
+
+
+def save_preview(labels, img, filename, max_size=1024):
+    """This function saves the thumbnails of preview_images as "<filename>_processed.png" and "<filename>_raw.png"."""
+    processed, raw = preview_images(labels, img, max_size)
+    io.imsave(filename + '_processed.png', processed, check_contrast=False)
+    io.imsave(filename + '_raw.png', raw, check_contrast=False)
+
+
+class FigureRenderer:
+    """This class renders the figures of the processed images in background threads, so that the figures of one image are drawn
+    while the next image is being segmented and measured. "mode" is "full" (the figures of "plot_function", plotfig_separate by
+    default), "preview" (the thumbnails of save_preview) or "none" (no figures at all, for batch runs). If a StageProfiler is
+    given, the rendering of each image is recorded in it, under the name of the file."""
+
+    def __init__(self, mode='full', max_workers=1, plot_function=plotfig_separate, preview_size=1024, profiler=None):
+        if mode not in ('full', 'preview', 'none'):
+            raise ValueError('Unknown figure mode: ' + str(mode))
+        self.mode = mode
+        self.plot_function = plot_function
+        self.preview_size = preview_size
+        self.profiler = profiler
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.futures = []
+
+    def submit(self, labels, region_properties, img, filename, profiler=None, image=None, **kwargs):
+        """This function queues the figures of one image and returns their future (None in "none" mode), whose result() raises the
+        error of the figures if they failed. The arrays must not be modified afterwards. The figures are recorded in "profiler"
+        if given (in the StageProfiler of the renderer otherwise), under the name "image" (the name of the file by default).
+        The other keyword arguments are passed to "plot_function" in "full" mode."""
+        if self.mode == 'none':
+            return None
+        if self.mode == 'preview':
+            task = (save_preview, labels, img, filename, self.preview_size)
+            kwargs = {}
+        else:
+            task = (self.plot_function, labels, region_properties, img, filename)
+        profiler = profiler if profiler is not None else self.profiler
+        if profiler is not None:
+            image = image if image is not None else os.path.basename(filename)
+            future = self.executor.submit(profiler.run, *task, image=image, **kwargs)
+        else:
+            future = self.executor.submit(*task, **kwargs)
+        # Forgets the figures already saved, but keeps the failed ones, so that wait raises their error.
+        self.futures = [i for i in self.futures if not i.done() or i.exception() is not None] + [future]
+        return future
 
-    plt.gca().set_axis_off()
-    plt.subplots_adjust(top=1, bottom=0, right=1, left=0, hspace=0, wspace=0)
-    plt.margins(0, 0)
-    plt.gca().xaxis.set_major_locator(plt.NullLocator())
-    plt.gca().yaxis.set_major_locator(plt.NullLocator())
-    plt.savefig(filename + '_raw.png', dpi=out_dpi, bbox_inches='tight', pad_inches=0)
-    plt.close()
+    def wait(self):
+        """This function waits until all the queued figures are saved, and raises the error of the first figure that failed."""
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
 
 
 def filter_labels_by_eccentricity(labels, eccentricity):
     """This function filters out labels that have an eccentricity below the value of the "eccentricity" parameter. The output is a labelled image."""
-    props = measure.regionprops(labels)
-    labels_cleaned = np.zeros_like(labels)
-    for i in props:
-        if i.eccentricity > eccentricity:
-            labels_cleaned[labels == i.label] = i.label
-    return labels_cleaned
+    return filter_labels(labels, [eccentricity_filter(eccentricity)])
 
 
 def filter_labels_by_minor_axis_length(labels, length_in_nm, pixel_size):
     """This function filters out labels that have a minor axis length above the value of the "length in nm" parameter. The output is a labelled image."""
-    props = measure.regionprops(labels)
-    labels_cleaned = np.zeros_like(labels)
-    for i in props:
-        if i.minor_axis_length * pixel_size < length_in_nm:
-            labels_cleaned[labels == i.label] = i.label
-    return labels_cleaned
+    return filter_labels(labels, [minor_axis_length_filter(length_in_nm, pixel_size)])
 
 
 def create_length_prop(properties, pixel_size):
@@ -161,20 +946,532 @@ def create_length_prop(properties, pixel_size):
     return properties
 
 
+def feret_diameters_fast(labels, label_ids, tolerance=1e-9):
+    """This function computes the maximum Feret diameter, in pixels, of each label in "label_ids", like regionprops' feret_diameter_max
+    but much faster for big objects. regionprops rasterises the convex hull of the object (the polygon through the edge midpoints of its
+    pixels), and measures the largest distance between the points of the contour of that convex hull image. Here, the hull polygon is
+    computed from the boundary pixels of all the labels, found in one pass, and each row of the convex hull image is found directly as
+    the interval of pixel centres between the two sides of the polygon. The contour points at the ends of each row interval give the
+    same convex hull, hence the same diameter, as the full contour. "tolerance" makes the pixel centres on the polygon count as inside,
+    like in regionprops."""
+    from scipy.spatial import ConvexHull, QhullError
+    boundaries = segmentation.find_boundaries(labels, mode='inner')
+    rows, cols = np.nonzero(boundaries)
+    owners = labels[rows, cols]
+    order = np.argsort(owners, kind='stable')  # Groups the boundary pixels by label.
+    points, owners = np.stack([rows[order], cols[order]], axis=1).astype(np.float64), owners[order]
+    starts = np.searchsorted(owners, label_ids, side='left')
+    ends = np.searchsorted(owners, label_ids, side='right')
+    edge_midpoints = np.array([[-0.5, 0], [0.5, 0], [0, -0.5], [0, 0.5]])
+
+    def farthest_pair_distance(contour_points):
+        try:
+            contour_points = contour_points[ConvexHull(contour_points).vertices]
+        except QhullError:  # The points are all on a line.
+            pass
+        differences = contour_points[:, np.newaxis, :] - contour_points[np.newaxis, :, :]
+        return np.sqrt(np.max(np.sum(differences**2, axis=-1)))
+
+    diameters = np.zeros(len(label_ids))
+    for k, (start, end) in enumerate(zip(starts, ends)):
+        if end == start:
+            continue
+        label_points = (points[start:end, np.newaxis, :] + edge_midpoints).reshape(-1, 2)
+        try:
+            hull = label_points[ConvexHull(label_points).vertices]  # In order around the polygon.
+        except QhullError:
+            diameters[k] = farthest_pair_distance(label_points)
+            continue
+
+        # Finds, for each row of pixel centres, where it enters and leaves the polygon. The horizontal edges are skipped, since
+        # their ends are also the ends of the edges next to them.
+        y0, x0 = hull[:, 0], hull[:, 1]
+        y1, x1 = np.roll(y0, -1), np.roll(x0, -1)
+        hull_rows = np.arange(np.ceil(y0.min() - tolerance), np.floor(y0.max() + tolerance) + 1)[:, np.newaxis]
+        crossing = (y0 != y1) & (hull_rows >= np.minimum(y0, y1) - tolerance) & (hull_rows <= np.maximum(y0, y1) + tolerance)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = x0 + (hull_rows - y0) * (x1 - x0) / (y1 - y0)
+        left = np.ceil(np.where(crossing, x, np.inf).min(axis=1) - tolerance)
+        right = np.floor(np.where(crossing, x, -np.inf).max(axis=1) + tolerance)
+        filled = left <= right
+        hull_rows, left, right = hull_rows[filled, 0], left[filled], right[filled]
+
+        # The contour points around the first and last pixels of each row of the convex hull image.
+        contour_points = np.concatenate([
+            np.stack([hull_rows, left - 0.5], axis=1),
+            np.stack([hull_rows, right + 0.5], axis=1),
+            np.stack([hull_rows - 0.5, left], axis=1),
+            np.stack([hull_rows + 0.5, left], axis=1),
+            np.stack([hull_rows - 0.5, right], axis=1),
+            np.stack([hull_rows + 0.5, right], axis=1),
+        ])
+        diameters[k] = farthest_pair_distance(contour_points)
+    return diameters
+
+
+def measure_labels(labels, pixel_size, fast_feret=False):
+    """This function measures all the labels of a labelled image at once and returns a columnar table: a dictionary of NumPy arrays
+    with one entry per label, like skimage.measure.regionprops_table. The columns are "label", "centroid-0" and "centroid-1" (in pixels),
+    "area" (in nm square), "minor_axis_length", "eccentricity", "feret_diameter_max", "length" and "area_to_length" (in nm).
+    "length" and "area_to_length" are the ones of create_length_prop, computed for all the labels with array maths.
+    If "fast_feret" is True, the Feret diameter is computed with feret_diameters_fast instead of regionprops."""
+    properties = ['label', 'centroid', 'area', 'minor_axis_length', 'eccentricity']
+    if not fast_feret:
+        properties.append('feret_diameter_max')
+    table = measure.regionprops_table(labels, properties=properties)
+    if fast_feret:
+        table['feret_diameter_max'] = feret_diameters_fast(labels, table['label'])
+
+    table['area'] = table['area'] * pixel_size * pixel_size
+    table['minor_axis_length'] = table['minor_axis_length'] * pixel_size
+    table['feret_diameter_max'] = table['feret_diameter_max'] * pixel_size
+    with np.errstate(invalid='ignore', divide='ignore'):
+        table['length'] = np.sqrt(table['feret_diameter_max']**2 - 18**2)  # From Pythagoras's theorem.
+        table['area_to_length'] = table['area'] / table['length']
+    return table
+
+
 def filter_labels_by_area(labels, area_in_nm2, pixel_size):
     """This function filters out labels that have an area below the value of the "area" parameter. The output is a labelled image."""
-    props = measure.regionprops(labels)
-    labels_cleaned = np.zeros_like(labels)
-    for i in props:
-        if i.area * pixel_size * pixel_size > area_in_nm2:
-            labels_cleaned[labels == i.label] = i.label
-    return labels_cleaned
+    return filter_labels(labels, [area_filter(area_in_nm2, pixel_size)])
+
+
+def filter_labels_by_area_to_width_ratio(labels, pixel_size, min_ratio, max_ratio):
+    """This function filters out labels that have area to width ratios that fall outside the min_ratio to max_ratio interval."""
+    return filter_labels(labels, [area_to_length_filter(pixel_size, min_ratio, max_ratio)])
 
 
 def reorder_labels(labels):
     """This function reorders the labels so as to make them start from 1."""
-    props = measure.regionprops(labels)
-    labels_cleaned = np.zeros_like(labels)
-    for i, j in enumerate(props):
-        labels_cleaned[labels == j.label] = i + 1
-    return labels_cleaned
+    return filter_labels(labels, [], reorder=True)
+
+
+def area_filter(area_in_nm2, pixel_size):
+    """This function returns a label filter that keeps the labels with an area above "area_in_nm2"."""
+    return LabelFilter(('area',), lambda props: props['area'] * pixel_size * pixel_size > area_in_nm2)
+
+
+def minor_axis_length_filter(length_in_nm, pixel_size):
+    """This function returns a label filter that keeps the labels with a minor axis length below "length_in_nm"."""
+    return LabelFilter(('minor_axis_length',), lambda props: props['minor_axis_length'] * pixel_size < length_in_nm)
+
+
+def eccentricity_filter(eccentricity):
+    """This function returns a label filter that keeps the labels with an eccentricity above "eccentricity"."""
+    return LabelFilter(('eccentricity',), lambda props: props['eccentricity'] > eccentricity)
+
+
+def area_to_length_filter(pixel_size, min_ratio, max_ratio):
+    """This function returns a label filter that keeps the labels with an area to length ratio within the min_ratio to max_ratio interval.
+    The length is the one from Pythagoras's theorem (see create_length_prop)."""
+    def test(props):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            length = np.sqrt((props['feret_diameter_max'] * pixel_size)**2 - 18**2)
+            area_to_length = (props['area'] * pixel_size * pixel_size) / length
+        return (area_to_length >= min_ratio) & (area_to_length <= max_ratio)
+    return LabelFilter(('area', 'feret_diameter_max'), test)
+
+
+def filter_labels(labels, label_filters, reorder=False):
+    """This function applies several label filters at once. The regions are measured a single time, every filter is evaluated on
+    that table, and the output labelled image is built with one lookup table pass, so the cost is linear in the number of pixels.
+    Keeping a label requires passing all of the filters, which gives the same labels as chaining the filter_labels_by_* functions.
+    If "reorder" is True the kept labels are also renumbered to start from 1, as reorder_labels does."""
+    properties = ['label']
+    for label_filter in label_filters:
+        properties.extend(p for p in label_filter.properties if p not in properties)
+    props = measure.regionprops_table(labels, properties=properties)  # Measures all the regions once.
+
+    keep = np.ones(len(props['label']), dtype=bool)
+    for label_filter in label_filters:
+        keep &= np.asarray(label_filter.test(props), dtype=bool)
+    kept_labels = props['label'][keep]
+
+    # The lookup table maps every old label to its new value (0 for the labels that are filtered out).
+    lut = np.zeros(int(labels.max(initial=0)) + 1, dtype=labels.dtype)
+    if reorder:
+        lut[kept_labels] = np.arange(1, len(kept_labels) + 1)
+    else:
+        lut[kept_labels] = kept_labels
+    return lut[labels]
+
+
+# Parameters of the pipeline of process_image_file, with their default values. They match the defaults of the Shiny app.
+DEFAULT_PARAMETERS = {
+    'block_size': 301,
+    'erosions': 1,
+    'dilations': 5,
+    'small_object_removal': 2000,
+    'small_holes_removal': 500,
+    'threshold_method': 'gaussian',
+    'seed_threshold': 0.2,
+    'watershed_method': 'full',
+    'per_component_seeds': False,
+    'area_in_nm2': 500,
+    'minor_axis_length_in_nm': 40,
+    'fast_feret': False,
+}
+
+# Parameters of DEFAULT_PARAMETERS that are passed to img_prep.
+PREP_PARAMETERS = ('block_size', 'erosions', 'dilations', 'small_object_removal', 'small_holes_removal', 'threshold_method')
+
+# Output of process_image_file: the name of the image, the image itself, its pixel size in nm, the labels of the nanorods that
+# were kept and their table of measure_labels.
+ProcessedImage = namedtuple('ProcessedImage', ['filename', 'img', 'pixel_size', 'labels', 'table'])
+
+
+def process_image_file(filepath, output_dir=None, parameters=None, profiler=None, cache=None, renderer=None, image=None,
+                       empty_figures=False):
+    """This function runs the whole pipeline on one image file (DM4 or MRC): img_prep, the watershed of "watershed_method", the
+    area and minor axis length filters, and measure_labels. It is shared by the batch script and the worker service, so that they
+    process the images the same way. The parameters that are not given in "parameters" take their DEFAULT_PARAMETERS value.
+    Every stage is recorded in "profiler" (a StageProfiler) under the name "image" (the name of the file by default), and
+    img_prep and the watershed go through "cache" (a StageCache) if given.
+    If "renderer" (a FigureRenderer) is given, the figures are saved in "output_dir", under the name of the file without its
+    extension, while the nanorods are measured, only if
+    nanorods were kept unless "empty_figures" is True, and they are waited for, so that their error is raised. The output is a
+    ProcessedImage."""
+    parameters = dict(DEFAULT_PARAMETERS, **(parameters or {}))
+    profiler = profiler if profiler is not None else StageProfiler(memory=None)
+    image = image if image is not None else image_name(filepath)
+
+    def run(stage, array, **stage_parameters):
+        # Like profiler.run, but through the cache if there is one.
+        with profiler.stage(stage.__name__, image) as record:
+            output = cache.run(stage, array, **stage_parameters) if cache is not None else stage(array, **stage_parameters)
+            record['objects'] = count_objects(output)
+        return output
+
+    # Opens and labels the image.
+    filename, img, pixel_size = profiler.run(open_mrc if is_mrc(filepath) else open_DM4, filepath, image=image)
+    binary = run(img_prep, img, **{name: parameters[name] for name in PREP_PARAMETERS})
+    watershed_parameters = {'seed_threshold': parameters['seed_threshold']}
+    if parameters['watershed_method'] == 'components':
+        watershed_parameters['per_component'] = parameters['per_component_seeds']
+    labels = run(WATERSHED_METHODS[parameters['watershed_method']], binary, **watershed_parameters)
+    labels = profiler.run(
+        filter_labels,
+        labels,
+        [
+            area_filter(parameters['area_in_nm2'], pixel_size),
+            minor_axis_length_filter(parameters['minor_axis_length_in_nm'], pixel_size)
+        ],
+        image=image,
+        reorder=True
+    )  # Filters by area and minor axis length and reorders the labels in a single pass.
+
+    # Plots and saves the figures in the background while the nanorods are measured.
+    figure = None
+    if renderer is not None and (empty_figures or labels.max() > 0):
+        figure = renderer.submit(
+            labels, measure.regionprops(labels), img, os.path.join(output_dir, image_name(filepath)), profiler=profiler, image=image
+        )
+
+    # Measures all the nanorods at once (area in nm square, lengths obtained from the Pythagoras theorem).
+    table = profiler.run(measure_labels, labels, pixel_size, image=image, fast_feret=parameters['fast_feret'])
+    if figure is not None:
+        figure.result()
+    return ProcessedImage(filename, img, pixel_size, labels, table)
+
+
+# Edges, in nm, of the bins of the length histograms of length_summary. The lengths outside them are counted in the end bins.
+LENGTH_BIN_EDGES = np.arange(0, 1000 + 5, 5)
+
+# Output of sweep_parameters: a table with one row per combination of parameters, and the edges of the bins of its histograms.
+SweepResult = namedtuple('SweepResult', ['summary', 'bin_edges'])
+
+
+def length_summary(lengths, bin_edges=LENGTH_BIN_EDGES):
+    """This function summarises a distribution of nanorod lengths (in nm): the number of nanorods, the mean, median, standard
+    deviation, quartiles and extremes of the lengths, and the counts of the histogram with "bin_edges", where the lengths below the
+    first edge or above the last one are counted in the first or last bin, so that the histogram counts every measured nanorod.
+    The lengths that are NaN (objects shorter than the width assumed by create_length_prop) are counted but left out of the
+    statistics, which are over the "measured" nanorods only."""
+    lengths = np.asarray(lengths, dtype=np.float64)
+    finite = lengths[np.isfinite(lengths)]
+    if len(finite) > 0:
+        mean, std = np.mean(finite), np.std(finite)
+        q25, median, q75 = np.percentile(finite, [25, 50, 75])
+        minimum, maximum = np.min(finite), np.max(finite)
+    else:
+        mean = std = q25 = median = q75 = minimum = maximum = np.nan
+    return {
+        'count': len(lengths),
+        'measured': len(finite),
+        'mean': mean,
+        'median': median,
+        'std': std,
+        'q25': q25,
+        'q75': q75,
+        'min': minimum,
+        'max': maximum,
+        'histogram': np.histogram(np.clip(finite, bin_edges[0], bin_edges[-1]), bins=bin_edges)[0].tolist(),
+    }
+
+
+def sweep_parameters(images, block_sizes=(301,), seed_thresholds=(0.2,), areas_in_nm2=(500,), minor_axis_lengths_in_nm=(40,),
+                     bin_edges=LENGTH_BIN_EDGES, max_workers=None, fast_feret=False, **prep_parameters):
+    """This function runs the pipeline on "images", a list of (image, pixel size) pairs, for every combination of the given
+    block sizes, seed thresholds, area cut-offs and minor axis length cut-offs, and summarises the nanorod lengths of each
+    combination over all the images with length_summary.
+    The combinations are evaluated as a tree, so that no work is repeated: img_prep and the distance transform are run once per
+    image and block size, watershed_distance once per mask and seed threshold, and measure_labels once per labelled image. The
+    area and minor axis length filters then select rows of that table, as area_filter and minor_axis_length_filter would select
+    labels. The masks and the labelled images are computed in parallel with "max_workers" threads, with a bounded number of masks
+    in memory at a time. "prep_parameters" are the
+    other parameters of img_prep, shared by all the combinations.
+    The output is a SweepResult, whose summary is a dictionary of columns with one row per combination."""
+    def prepare(img, block_size):
+        binary = img_prep(img, block_size=block_size, **prep_parameters)
+        return binary, ndi.distance_transform_edt(binary)
+
+    def label_and_measure(binary, distance, seed_threshold, pixel_size):
+        labels = watershed_distance(binary, distance, seed_threshold)
+        return measure_labels(labels, pixel_size, fast_feret=fast_feret)
+
+    tables = {}
+    max_pending = max_workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Like segment_tiled, at most "max_pending" masks are prepared at a time, and at most "max_pending" prepared masks wait
+        # for their seed thresholds, so that the masks and distances in memory don't grow with the number of images.
+        mask_keys = [(k, block_size) for k in range(len(images)) for block_size in block_sizes]
+        masks = map_bounded(executor, lambda key: prepare(images[key[0]][0], key[1]), mask_keys, max_pending)
+        waiting = deque()
+        for (k, block_size), (binary, distance) in zip(mask_keys, masks):
+            waiting.append({
+                (k, block_size, seed_threshold): executor.submit(
+                    label_and_measure, binary, distance, seed_threshold, images[k][1]
+                )
+                for seed_threshold in seed_thresholds
+            })
+            del binary, distance  # Only the jobs of the seed thresholds hold the mask now.
+            while len(waiting) > max_pending:
+                tables.update({key: future.result() for key, future in waiting.popleft().items()})
+        while waiting:
+            tables.update({key: future.result() for key, future in waiting.popleft().items()})
+
+    summary = {
+        'block_size': [], 'seed_threshold': [], 'area_in_nm2': [], 'minor_axis_length_in_nm': [],
+    }
+    for block_size, seed_threshold, area_in_nm2, length_in_nm in product(
+        block_sizes, seed_thresholds, areas_in_nm2, minor_axis_lengths_in_nm
+    ):
+        lengths = []
+        for k in range(len(images)):
+            table = tables[k, block_size, seed_threshold]
+            keep = (table['area'] > area_in_nm2) & (table['minor_axis_length'] < length_in_nm)
+            lengths.append(table['length'][keep])
+        row = dict(
+            block_size=block_size, seed_threshold=seed_threshold, area_in_nm2=area_in_nm2, minor_axis_length_in_nm=length_in_nm,
+            **length_summary(np.concatenate(lengths), bin_edges)
+        )
+        for column, value in row.items():
+            summary.setdefault(column, []).append(value)
+    return SweepResult(summary, np.asarray(bin_edges))
+
+
+def histogram_quantile(counts, bin_edges, q):
+    """This function estimates the quantile "q" (between 0 and 1) of the values counted in a histogram, assuming that the values
+    are spread evenly within each bin. It returns NaN for an empty histogram."""
+    counts = np.asarray(counts, dtype=np.float64)
+    total = counts.sum()
+    if total == 0:
+        return np.nan
+    cumulative = np.cumsum(counts)
+    k = int(np.searchsorted(cumulative, q * total))  # Bin in which the quantile falls.
+    before = cumulative[k - 1] if k > 0 else 0
+    return bin_edges[k] + (q * total - before) / counts[k] * (bin_edges[k + 1] - bin_edges[k])
+
+
+class ResultStore:
+    """This class is the store of the nanorods of an acquisition session: a single SQLite file with one row per nanorod, indexed
+    by GridSquare and image, and one row per image with the length_summary of its nanorods, computed when the image is written.
+    The summaries and histograms over any number of images are combined from the per-image rows, without reading the nanorods.
+    The bins of the histograms are fixed when the store is created (LENGTH_BIN_EDGES by default); the lengths outside them are
+    counted in the end bins (see length_summary)."""
+
+    def __init__(self, path, bin_edges=LENGTH_BIN_EDGES):
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.connection:
+            self.connection.executescript("""
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS nanorods (
+                    grid TEXT, image TEXT, nanorod_id INTEGER, coord_y REAL, coord_x REAL, area REAL, length REAL
+                );
+                CREATE INDEX IF NOT EXISTS nanorods_image ON nanorods (grid, image);
+                CREATE TABLE IF NOT EXISTS images (
+                    grid TEXT, image TEXT, count INTEGER, measured INTEGER, mean REAL, median REAL, std REAL,
+                    min REAL, max REAL, histogram BLOB, PRIMARY KEY (grid, image)
+                );
+            """)
+            self.connection.execute(
+                "INSERT OR IGNORE INTO meta VALUES ('bin_edges', ?)", (json.dumps(np.asarray(bin_edges).tolist()),)
+            )
+            stored_edges = self.connection.execute("SELECT value FROM meta WHERE key = 'bin_edges'").fetchone()[0]
+        self.bin_edges = np.array(json.loads(stored_edges), dtype=np.float64)  # The bins of an existing store are kept.
+
+    def write_image(self, grid, image, nanorod_ids, coords_y, coords_x, areas, lengths):
+        """This function saves the nanorods of one image, and its summary, replacing whatever was saved for it before. An image
+        without nanorods is saved too, so that it is counted."""
+        lengths = np.asarray(lengths, dtype=np.float64)
+        summary = length_summary(lengths, self.bin_edges)
+        rows = [
+            (grid, image, int(nanorod_id), float(y), float(x), float(area), None if np.isnan(length) else float(length))
+            for nanorod_id, y, x, area, length in zip(nanorod_ids, coords_y, coords_x, areas, lengths)
+        ]
+        with self.lock, self.connection:  # One transaction, so an image is either fully saved or not at all.
+            self.connection.execute('DELETE FROM nanorods WHERE grid = ? AND image = ?', (grid, image))
+            self.connection.executemany('INSERT INTO nanorods VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self.connection.execute(
+                'INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    grid, image, summary['count'], summary['measured'],
+                    *[None if np.isnan(summary[key]) else float(summary[key]) for key in ('mean', 'median', 'std', 'min', 'max')],
+                    np.asarray(summary['histogram'], dtype=np.int64).tobytes(),
+                )
+            )
+
+    def query(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    @staticmethod
+    def grid_condition(grids):
+        """This function returns the WHERE clause, and its parameters, that selects the rows of the given GridSquares (all if None)."""
+        if grids is None:
+            return '', ()
+        if isinstance(grids, str):
+            grids = [grids]  # A single GridSquare comes from R as a string.
+        return ' WHERE grid IN (' + ', '.join('?' * len(grids)) + ')', tuple(grids)
+
+    def grids(self):
+        return [row[0] for row in self.query('SELECT DISTINCT grid FROM images ORDER BY grid')]
+
+    def images(self, grids=None):
+        """This function returns the summary of every image of the given GridSquares (all by default) as a dictionary of columns.
+        Missing values are NaN."""
+        where, parameters = self.grid_condition(grids)
+        columns = ['grid', 'image', 'count', 'measured', 'mean', 'median', 'std', 'min', 'max']
+        rows = self.query('SELECT ' + ', '.join(columns) + ' FROM images' + where + ' ORDER BY grid, image', parameters)
+        table = {column: [row[k] for row in rows] for k, column in enumerate(columns)}
+        for column in columns[4:]:
+            table[column] = [np.nan if value is None else value for value in table[column]]
+        return table
+
+    @staticmethod
+    def length_condition(where, length_range):
+        """This function adds to the WHERE clause "where" the condition, and its parameters, that keeps the lengths within
+        "length_range" (all the measured lengths if None)."""
+        where += (' AND' if where else ' WHERE') + ' length IS NOT NULL'
+        if length_range is None:
+            return where, ()
+        return where + ' AND length BETWEEN ? AND ?', tuple(float(limit) for limit in length_range)
+
+    def nanorods(self, grids=None, length_range=None, images=None):
+        """This function returns the nanorods of the given GridSquares (all by default) as a dictionary of columns, keeping only
+        the images named in "images" and the lengths within "length_range" (a (min, max) pair, in nm) if they are given. Missing
+        lengths are NaN."""
+        where, parameters = self.grid_condition(grids)
+        if images is not None:
+            if isinstance(images, str):
+                images = [images]  # A single image comes from R as a string.
+            where += (' AND' if where else ' WHERE') + ' image IN (' + ', '.join('?' * len(images)) + ')'
+            parameters += tuple(images)
+        if length_range is not None:
+            where += (' AND' if where else ' WHERE') + ' length BETWEEN ? AND ?'
+            parameters += tuple(float(limit) for limit in length_range)
+        columns = ['grid', 'image', 'nanorod_id', 'coord_y', 'coord_x', 'area', 'length']
+        rows = self.query('SELECT ' + ', '.join(columns) + ' FROM nanorods' + where + ' ORDER BY grid, image, nanorod_id', parameters)
+        table = {column: [row[k] for row in rows] for k, column in enumerate(columns)}
+        table['length'] = [np.nan if value is None else value for value in table['length']]
+        return table
+
+    def histogram(self, grids=None, length_range=None):
+        """This function returns the counts of the length histogram of the given GridSquares (all by default), summed from the
+        per-image histograms. If "length_range" is given, only the bins that lie within it are kept, so the range is rounded to
+        the bins. The end bins also count the lengths outside the bins; when the range ends beyond them, the nanorods of a kept
+        end bin are counted again by SQLite, within the range. The edges of the bins are in "bin_edges"."""
+        where, parameters = self.grid_condition(grids)
+        counts = np.zeros(len(self.bin_edges) - 1, dtype=np.int64)
+        for (histogram,) in self.query('SELECT histogram FROM images' + where, parameters):
+            counts += np.frombuffer(histogram, dtype=np.int64)
+        if length_range is not None:
+            counts[(self.bin_edges[:-1] < length_range[0]) | (self.bin_edges[1:] > length_range[1])] = 0
+            length_where, length_parameters = self.length_condition(where, length_range)
+            if counts[0] > 0 and length_range[0] < self.bin_edges[0]:
+                counts[0] = self.query(
+                    'SELECT COUNT(*) FROM nanorods' + length_where + ' AND length <= ?',
+                    parameters + length_parameters + (float(self.bin_edges[1]),)
+                )[0][0]
+            if counts[-1] > 0 and length_range[1] > self.bin_edges[-1]:
+                counts[-1] = self.query(
+                    'SELECT COUNT(*) FROM nanorods' + length_where + ' AND length >= ?',
+                    parameters + length_parameters + (float(self.bin_edges[-2]),)
+                )[0][0]
+        return counts.tolist()
+
+    def median(self, grids=None, length_range=None):
+        """This function returns the exact median of the measured lengths of the given GridSquares (all by default), within
+        "length_range" if it is given, by sorting the lengths in SQLite. It returns NaN if there are none."""
+        where, parameters = self.grid_condition(grids)
+        where, length_parameters = self.length_condition(where, length_range)
+        parameters += length_parameters
+        measured = self.query('SELECT COUNT(*) FROM nanorods' + where, parameters)[0][0]
+        if measured == 0:
+            return np.nan
+        middle = self.query(
+            'SELECT length FROM nanorods' + where + ' ORDER BY length LIMIT ? OFFSET ?',
+            parameters + (2 - measured % 2, (measured - 1) // 2)
+        )
+        return float(np.mean([row[0] for row in middle]))
+
+    def summary(self, grids=None, length_range=None):
+        """This function returns the number, mean, median, sample standard deviation, minimum and maximum of the measured lengths
+        of the given GridSquares (all by default), as a dictionary. When "length_range" isn't given or covers all the lengths,
+        they are combined from the per-image summaries; otherwise the nanorods within the range are aggregated by SQLite.
+        The median is estimated from the histogram, to within a fraction of a bin, when the histogram counts the same nanorods: it
+        is computed exactly by SQLite instead (see median) when the nanorods are aggregated by SQLite, when "length_range" doesn't
+        fall on the edges of the bins, or when some of the lengths lie outside the bins."""
+        where, parameters = self.grid_condition(grids)
+        measured, total, total_squares, minimum, maximum = self.query(
+            'SELECT SUM(measured), SUM(mean * measured), SUM((std * std + mean * mean) * measured), MIN(min), MAX(max) FROM images'
+            + where, parameters
+        )[0]
+        aggregated = length_range is not None and measured and (length_range[0] > minimum or length_range[1] < maximum)
+        if aggregated:
+            length_where, length_parameters = self.length_condition(where, length_range)
+            measured, total, total_squares, minimum, maximum = self.query(
+                'SELECT COUNT(length), SUM(length), SUM(length * length), MIN(length), MAX(length) FROM nanorods' + length_where,
+                parameters + length_parameters
+            )[0]
+        if not measured:
+            return {'count': 0, 'mean': np.nan, 'median': np.nan, 'std': np.nan, 'min': np.nan, 'max': np.nan}
+        mean = total / measured
+        variance = max(total_squares / measured - mean**2, 0) * measured / (measured - 1) if measured > 1 else np.nan
+        on_edges = length_range is None or all(
+            float(limit) in self.bin_edges or not self.bin_edges[0] < limit < self.bin_edges[-1] for limit in length_range
+        )  # Otherwise the histogram drops the bins that straddle the range, and the nanorods within the range they hold.
+        if aggregated or not on_edges or minimum < self.bin_edges[0] or maximum > self.bin_edges[-1]:
+            median = self.median(grids, length_range)  # The end bins don't tell where their lengths lie either.
+        else:
+            median = histogram_quantile(self.histogram(grids, length_range), self.bin_edges, 0.5)
+        return {
+            'count': measured,
+            'mean': float(mean),
+            'median': float(median),
+            'std': float(np.sqrt(variance)),
+            'min': minimum,
+            'max': maximum,
+        }
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
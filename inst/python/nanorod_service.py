@@ -0,0 +1,578 @@
+# -*- coding: utf-8 -*-
+"""
+Local worker service for the nanorod pipeline.
+
+The service runs the pipeline of electron_microscopy.py on a pool of worker processes, behind a small job queue. A job is a list of
+images (DM4 or MRC) processed with the same parameters; the images of all the jobs are fed to the pool in turn, so a big job doesn't
+hold back the jobs submitted after it. The clients talk to the service with one JSON object per line over a Unix socket that only
+its user can open (the default), or over a localhost TCP port where Unix sockets don't exist, with the calls submit, status,
+progress, result, cancel and forget (see ServiceClient). Since the service reads and writes files as its user, every request must
+also carry the token of the service when it has one (always over TCP, see start_service). The jobs live in the service, not in
+the clients, so they keep running when a Shiny session disconnects and can be followed from any session.
+
+Usage: python nanorod_service.py [--socket PATH | --port 47600] [--token-file PATH] [--processes N] [--cache-dir DIR]
+"""
+
+import os
+import sys
+import hmac
+import json
+import time
+import uuid
+import socket
+import secrets
+import argparse
+import threading
+import subprocess
+import socketserver
+from collections import deque
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from electron_microscopy import DEFAULT_PARAMETERS  # Only numpy: the image libraries are imported by the workers, when used.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not available on Windows, where the service listens on a TCP port instead of a Unix socket.
+
+# Folder of the socket and the token of the service by default. Only its user can open it.
+DEFAULT_FOLDER = os.path.join(os.path.expanduser('~'), '.nanorod')
+
+# Address on which the service listens by default: a Unix socket in DEFAULT_FOLDER, or a TCP port of the local machine only
+# where there are no Unix sockets (Windows).
+if hasattr(socket, 'AF_UNIX'):
+    DEFAULT_ADDRESS = os.path.join(DEFAULT_FOLDER, 'service.sock')
+else:
+    DEFAULT_ADDRESS = ('127.0.0.1', 47600)
+
+# File of the token of the service by default.
+DEFAULT_TOKEN_PATH = os.path.join(DEFAULT_FOLDER, 'service.token')
+
+# Number of seconds for which a finished job is kept, so that a reconnected session can still fetch its result.
+JOB_LIFETIME = 24 * 3600
+
+# Number of times an image is given to the pool before it is recorded as failed, if the worker processing it dies every time.
+MAX_ATTEMPTS = 2
+
+
+def warm_up():
+    """This function imports the libraries of the pipeline when a worker process starts, and logs how long it took and the
+    modules that aren't installed. It never raises, since an error in the initializer of a worker breaks the whole pool: the
+    libraries that fail to import here are imported again, and their errors reported, by the images that need them."""
+    try:
+        import electron_microscopy as em
+        start = time.perf_counter()
+        missing = [name for name, seconds in em.preload(plotting=True).items() if seconds is None]
+        print('Worker', os.getpid(), 'ready in', round(time.perf_counter() - start, 2), 's', flush=True)
+        if missing:
+            print('Worker', os.getpid(), 'skipped the modules that are not installed:', ', '.join(missing), flush=True)
+    except Exception as error:
+        print('Worker', os.getpid(), 'could not preload the pipeline:', repr(error), flush=True)
+
+
+def plot_figures(labels, region_properties, img, filename):
+    """This function saves the full figures of an image, at a lower resolution than plotfig_separate by default."""
+    import electron_microscopy as em
+    em.plotfig_separate(labels, region_properties, img, filename, out_dpi=300)
+
+
+# Figure renderers of this worker process, by figure mode.
+FIGURE_RENDERERS = {}
+
+
+def process_job_image(filepath, output_dir, parameters, figures='preview', cache_dir=None):
+    """This function runs the pipeline on one image in a worker process with process_image_file, saves its figures in
+    "output_dir" (see FigureRenderer for "figures") and returns the name of the image, its table of measure_labels and its
+    StageProfiler records, as lists so that they can be sent as JSON. If "cache_dir" is given, the thresholding and watershed
+    outputs go through a StageCache there."""
+    import electron_microscopy as em  # Imported by the workers only, so that the clients don't load the image libraries.
+
+    if figures not in FIGURE_RENDERERS:
+        FIGURE_RENDERERS[figures] = em.FigureRenderer(figures, plot_function=plot_figures)
+    profiler = em.StageProfiler()
+    image = em.image_name(filepath)
+    cache = em.StageCache(cache_dir) if cache_dir is not None else None
+    table = em.process_image_file(
+        filepath, output_dir, parameters, profiler=profiler, cache=cache, renderer=FIGURE_RENDERERS[figures], image=image,
+        empty_figures=True
+    ).table
+
+    return {
+        'image': image,
+        'table': {column: values.tolist() for column, values in table.items()},
+        'profile': profiler.records,
+    }
+
+
+class Job:
+    """This class holds the state of one job: the images still to be processed, the results and errors of the processed ones,
+    and its state, which is "queued", "running", "done" or "cancelled"."""
+
+    def __init__(self, images, output_dir, parameters, figures):
+        self.job_id = uuid.uuid4().hex
+        self.images = list(images)
+        self.output_dir = output_dir
+        self.parameters = parameters
+        self.figures = figures
+        self.pending = deque(self.images)
+        self.attempts = {}  # Number of times each image was given to the pool.
+        self.running = 0
+        self.results = {}
+        self.errors = {}
+        self.state = 'queued'
+        self.submitted = time.time()
+        self.finished = None
+
+    def status(self):
+        return {
+            'job_id': self.job_id,
+            'state': self.state,
+            'output_dir': self.output_dir,
+            'submitted': self.submitted,
+            'finished': self.finished,
+        }
+
+    def progress(self):
+        processed = len(self.results) + len(self.errors)
+        return dict(
+            self.status(),
+            total=len(self.images),
+            done=len(self.results),
+            failed=len(self.errors),
+            running=self.running,
+            pending=len(self.pending),
+            fraction=processed / len(self.images) if len(self.images) > 0 else 1.0,
+        )
+
+    def result(self):
+        """This function returns the results of the images processed so far, in the order in which they were submitted: the
+        names of the images, their nanorods as one table of columns with an "image_name" column (empty if no image was processed),
+        the errors of the failed images, and the StageProfiler records as a table of columns, with NaN for the missing values."""
+        images = [self.results[filepath]['image'] for filepath in self.images if filepath in self.results]
+        table = {}
+        profile = {}
+        for filepath in self.images:
+            if filepath not in self.results:
+                continue
+            image_result = self.results[filepath]
+            image_table = dict(image_result['table'])
+            image_table['image_name'] = [image_result['image']] * len(image_table['label'])
+            for column, values in image_table.items():
+                table.setdefault(column, []).extend(values)
+            for record in image_result['profile']:
+                for field, value in record.items():
+                    profile.setdefault(field, []).append(float('nan') if value is None else value)
+        return dict(self.status(), images=images, table=table, errors=self.errors, profile=profile)
+
+
+class WorkerService:
+    """This class runs the jobs on a pool of "processes" worker processes (all the cores by default). A dispatcher thread takes
+    the images of the queued jobs in turn, one image per job, and keeps at most "max_pending" images in the pool, so that a job
+    submitted behind a big one starts straight away. If a worker process dies (killed, or out of memory), the pool is replaced
+    and the images it was processing are given to the new pool again, up to MAX_ATTEMPTS times each."""
+
+    def __init__(self, processes=None, cache_dir=None, max_pending=None):
+        self.processes = processes
+        self.executor = self.new_executor()
+        self.cache_dir = cache_dir
+        self.max_pending = max_pending or 2 * (processes or os.cpu_count() or 1)
+        self.jobs = {}
+        self.queue = deque()  # Jobs with images still to be dispatched, in turn.
+        self.in_flight = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        self.dispatcher = threading.Thread(target=self.dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def new_executor(self):
+        return ProcessPoolExecutor(max_workers=self.processes, initializer=warm_up)
+
+    def replace_executor(self, executor):
+        """This function replaces "executor" with a new pool if it is still the current one, since a pool whose worker died is
+        broken for good. It must be called with the condition held."""
+        if executor is self.executor and not self.closed:
+            print('A worker process died, restarting the pool', flush=True)
+            self.executor = self.new_executor()
+            executor.shutdown(wait=False)  # May be called from the thread of the broken pool, which can't be waited for.
+
+    def requeue(self, job, filepath):
+        """This function puts an image back at the front of its job, and the job at the front of the queue."""
+        job.pending.appendleft(filepath)
+        if job not in self.queue:
+            self.queue.appendleft(job)
+
+    def dispatch(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or (self.queue and self.in_flight < self.max_pending))
+                if self.closed:
+                    return
+                job = self.queue.popleft()
+                filepath = job.pending.popleft()
+                if job.pending:
+                    self.queue.append(job)  # The job goes back to the end of the queue.
+                job.state = 'running'
+                job.running += 1
+                job.attempts[filepath] = job.attempts.get(filepath, 0) + 1
+                self.in_flight += 1
+                executor = self.executor
+            # The image is given to the pool outside the lock, since the pool can run the callback straight away.
+            try:
+                future = executor.submit(
+                    process_job_image, filepath, job.output_dir, job.parameters, job.figures, self.cache_dir
+                )
+            except BrokenProcessPool:
+                # The pool broke before the image was given to it, so the image doesn't count as an attempt.
+                with self.condition:
+                    self.replace_executor(executor)
+                    self.in_flight -= 1
+                    job.running -= 1
+                    job.attempts[filepath] -= 1
+                    if job.state == 'running':
+                        self.requeue(job, filepath)
+                    self.condition.notify_all()
+                continue
+            future.add_done_callback(partial(self.finish, job, filepath, executor))
+
+    def finish(self, job, filepath, executor, future):
+        with self.condition:
+            self.in_flight -= 1
+            job.running -= 1
+            try:
+                job.results[filepath] = future.result()
+            except BrokenProcessPool as error:
+                self.replace_executor(executor)
+                if job.state == 'running' and job.attempts[filepath] < MAX_ATTEMPTS:
+                    self.requeue(job, filepath)
+                else:
+                    job.errors[filepath] = repr(error)
+            except Exception as error:
+                job.errors[filepath] = repr(error)
+            if job.state == 'running' and not job.pending and job.running == 0:
+                job.state = 'done'
+                job.finished = time.time()
+            self.condition.notify_all()
+
+    def job(self, job_id):
+        if job_id not in self.jobs:
+            raise KeyError('Unknown job: ' + str(job_id))
+        return self.jobs[job_id]
+
+    def submit(self, images, output_dir, parameters=None, figures='preview'):
+        """This function queues a job and returns its identifier. The parameters that are not given take their
+        DEFAULT_PARAMETERS value."""
+        unknown = set(parameters or {}) - set(DEFAULT_PARAMETERS)
+        if unknown:
+            raise ValueError('Unknown parameters: ' + ', '.join(sorted(unknown)))
+        if figures not in ('full', 'preview', 'none'):
+            raise ValueError('Unknown figure mode: ' + str(figures))
+        os.makedirs(output_dir, exist_ok=True)
+        job = Job(images, output_dir, dict(DEFAULT_PARAMETERS, **(parameters or {})), figures)
+        with self.condition:
+            # Deletes the jobs that finished long ago.
+            for old_job in list(self.jobs.values()):
+                if old_job.finished is not None and old_job.finished < time.time() - JOB_LIFETIME:
+                    del self.jobs[old_job.job_id]
+            self.jobs[job.job_id] = job
+            if job.pending:
+                self.queue.append(job)
+            else:
+                job.state = 'done'
+                job.finished = time.time()
+            self.condition.notify_all()
+        return job.job_id
+
+    def status(self, job_id):
+        with self.condition:
+            return self.job(job_id).status()
+
+    def progress(self, job_id):
+        with self.condition:
+            return self.job(job_id).progress()
+
+    def result(self, job_id):
+        with self.condition:
+            return self.job(job_id).result()
+
+    def cancel(self, job_id):
+        """This function drops the images of a job that haven't been given to the pool yet. The results so far are kept."""
+        with self.condition:
+            job = self.job(job_id)
+            if job.state in ('queued', 'running'):
+                job.pending.clear()
+                if job in self.queue:
+                    self.queue.remove(job)
+                job.state = 'cancelled'
+                job.finished = time.time()
+            return job.status()
+
+    def forget(self, job_id):
+        """This function cancels a job and deletes it from the service, once its results have been fetched."""
+        self.cancel(job_id)
+        with self.condition:
+            del self.jobs[job_id]
+        return {'job_id': job_id}
+
+    def handle(self, request):
+        """This function answers one request: a dictionary with the name of the call in "op" and its arguments."""
+        calls = {
+            'ping': lambda: {'pid': os.getpid(), 'jobs': len(self.jobs)},
+            'submit': lambda images, output_dir, parameters=None, figures='preview': {
+                'job_id': self.submit(images, output_dir, parameters, figures)
+            },
+            'status': self.status,
+            'progress': self.progress,
+            'result': self.result,
+            'cancel': self.cancel,
+            'forget': self.forget,
+        }
+        request = dict(request)
+        op = request.pop('op', None)
+        if op not in calls:
+            raise ValueError('Unknown call: ' + str(op))
+        return calls[op](**request)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.executor.shutdown(cancel_futures=True)
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+    """This class answers the requests of one connection, one JSON object per line. An error is sent back as {"error": ...}.
+    If the server has a token, the requests that don't carry it in "token" are refused."""
+
+    def handle(self):
+        for line in self.rfile:
+            shutdown = False
+            try:
+                request = json.loads(line)
+                token = str(request.pop('token', ''))
+                if self.server.token is not None and not hmac.compare_digest(token, self.server.token):
+                    raise PermissionError('Invalid token.')
+                if request.get('op') == 'shutdown':
+                    shutdown = True
+                    response = {'pid': os.getpid()}
+                else:
+                    response = self.server.service.handle(request)
+            except Exception as error:
+                response = {'error': repr(error)}
+            self.wfile.write((json.dumps(response) + '\n').encode())
+            if shutdown:
+                # Only once answered, since the process may exit before this thread gets to write.
+                self.wfile.flush()
+                threading.Thread(target=self.server.shutdown).start()
+
+
+class TCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class UnixServer(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+else:
+    UnixServer = None  # There are no Unix sockets on Windows.
+
+
+def parse_address(address):
+    """This function returns a Unix socket path (a string) as is, and a (host, port) pair, which may come from R as a list, as a tuple."""
+    if isinstance(address, str):
+        return address
+    host, port = address
+    return host, int(port)
+
+
+def read_token(token_path, create=False):
+    """This function returns the token saved in "token_path". If "create" is True and there is no token yet, a random one is
+    saved first, in a file that only its user can read."""
+    if create and not os.path.exists(token_path):
+        os.makedirs(os.path.dirname(os.path.abspath(token_path)), mode=0o700, exist_ok=True)
+        try:
+            descriptor = os.open(token_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            with os.fdopen(descriptor, 'w') as token_file:
+                token_file.write(secrets.token_hex(32))
+        except FileExistsError:
+            pass  # Created by another session in the meantime.
+    with open(token_path) as token_file:
+        return token_file.read().strip()
+
+
+def lock_socket(socket_path):
+    """This function takes the lock of the Unix socket "socket_path", a lock file next to it held for as long as the service
+    runs, so that a second service started at the same time can't take the socket over from the first. The output is the
+    descriptor of the lock file, or None if another service holds the lock."""
+    descriptor = os.open(socket_path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(descriptor)
+        return None
+    return descriptor
+
+
+def serve(address=DEFAULT_ADDRESS, processes=None, cache_dir=None, token=None):
+    """This function runs the service on "address" until it is asked to shut down. A Unix socket is created so that only its
+    user can connect to it, unless another service already runs on it, in which case this function returns straight away.
+    If "token" is given, the requests must carry it; it is required on a TCP port, which any user of the machine can connect
+    to."""
+    address = parse_address(address)
+    lock = None
+    if isinstance(address, str):
+        if UnixServer is None:
+            raise OSError('Unix sockets are not available on this system.')
+        os.makedirs(os.path.dirname(os.path.abspath(address)), mode=0o700, exist_ok=True)
+        lock = lock_socket(address)
+        if lock is None:
+            print('Another nanorod service is already listening on', address, flush=True)
+            return
+        if os.path.exists(address):
+            os.remove(address)  # Left by a service that didn't shut down cleanly, since the lock was free.
+        umask = os.umask(0o177)  # The socket is created with the permissions 0600.
+        try:
+            server = UnixServer(address, RequestHandler)
+        finally:
+            os.umask(umask)
+    else:
+        if token is None:
+            raise ValueError('A token is required to listen on a TCP port.')
+        server = TCPServer(address, RequestHandler)
+    server.token = token
+    server.service = WorkerService(processes=processes, cache_dir=cache_dir)
+    print('Nanorod service listening on', address, '( pid', os.getpid(), ')', flush=True)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        server.service.close()
+        if lock is not None:
+            if os.path.exists(address):
+                os.remove(address)
+            os.close(lock)  # Releases the lock, now that the socket is removed.
+
+
+class ServiceClient:
+    """This class calls the service at "address", with the token saved in "token_path" if given. Each call opens its own
+    connection, so a client survives restarts of the service and can be used from several threads or R sessions. The errors of
+    the service are raised as RuntimeError."""
+
+    def __init__(self, address=DEFAULT_ADDRESS, token_path=None, timeout=30):
+        self.address = parse_address(address)
+        self.token_path = token_path
+        self.timeout = timeout
+
+    def call(self, op, **arguments):
+        family = socket.AF_UNIX if isinstance(self.address, str) else socket.AF_INET
+        request = dict(arguments, op=op)
+        if self.token_path is not None:
+            request['token'] = read_token(self.token_path)
+        with socket.socket(family, socket.SOCK_STREAM) as connection:
+            connection.settimeout(self.timeout)
+            connection.connect(self.address)
+            with connection.makefile('rwb') as stream:
+                stream.write((json.dumps(request) + '\n').encode())
+                stream.flush()
+                line = stream.readline()
+        if not line:
+            raise RuntimeError('The nanorod service closed the connection.')
+        response = json.loads(line)
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def ping(self):
+        return self.call('ping')
+
+    def submit(self, images, output_dir, parameters=None, figures='preview'):
+        """This function queues the images as one job and returns the identifier of the job."""
+        if isinstance(images, str):
+            images = [images]  # A single image comes from R as a string.
+        return self.call('submit', images=list(images), output_dir=output_dir, parameters=parameters, figures=figures)['job_id']
+
+    def status(self, job_id):
+        return self.call('status', job_id=job_id)
+
+    def progress(self, job_id):
+        return self.call('progress', job_id=job_id)
+
+    def result(self, job_id):
+        return self.call('result', job_id=job_id)
+
+    def cancel(self, job_id):
+        return self.call('cancel', job_id=job_id)
+
+    def forget(self, job_id):
+        return self.call('forget', job_id=job_id)
+
+    def shutdown(self):
+        return self.call('shutdown')
+
+
+def start_service(address=DEFAULT_ADDRESS, python=None, processes=None, cache_dir=None, log_path=None, token_path=DEFAULT_TOKEN_PATH,
+                  timeout=60):
+    """This function returns a ServiceClient for the service at "address", starting the service in the background with the
+    Python interpreter "python" (this one by default) if it isn't running yet. The service outlives the caller, so it is shared
+    by all the R sessions of the user. Its output goes to "log_path" if given. The token of the service is read from
+    "token_path", and created there if there is none yet; with a token_path of None, there is no token, which is only allowed
+    on a Unix socket."""
+    if token_path is not None:
+        read_token(token_path, create=True)
+    client = ServiceClient(address, token_path)
+    try:
+        client.ping()
+        return client
+    except OSError:
+        pass
+
+    address = parse_address(address)
+    command = [python or sys.executable, os.path.abspath(__file__)]
+    command += ['--socket', address] if isinstance(address, str) else ['--host', address[0], '--port', str(address[1])]
+    if token_path is not None:
+        command += ['--token-file', token_path]
+    if processes is not None:
+        command += ['--processes', str(processes)]
+    if cache_dir is not None:
+        command += ['--cache-dir', cache_dir]
+    log = open(log_path, 'a') if log_path is not None else subprocess.DEVNULL
+    if os.name == 'nt':
+        detach = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP | subprocess.DETACHED_PROCESS}
+    else:
+        detach = {'start_new_session': True}
+    subprocess.Popen(command, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, **detach)
+    if log is not subprocess.DEVNULL:
+        log.close()
+
+    # Waits until the service answers. If another session started it at the same time, that one answers instead.
+    deadline = time.time() + timeout
+    while True:
+        try:
+            client.ping()
+            return client
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.2)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Runs the nanorod pipeline as a local worker service.')
+    parser.add_argument('--socket', default=None,
+                        help='Unix socket to listen on (default: ' + str(DEFAULT_ADDRESS) + ' where there are Unix sockets).')
+    parser.add_argument('--host', default='127.0.0.1', help='Host to listen on with --port (default: 127.0.0.1, this machine only).')
+    parser.add_argument('--port', type=int, default=None, help='Listens on this TCP port instead of a Unix socket. Needs --token-file.')
+    parser.add_argument('--token-file', default=None, help='File of the token that the requests must carry.')
+    parser.add_argument('-p', '--processes', type=int, default=None, help='Number of worker processes (default: all cores).')
+    parser.add_argument('--cache-dir', default=None, help='Folder of the StageCache shared by the workers (default: no cache).')
+    args = parser.parse_args(argv)
+    if args.port is not None:
+        address = (args.host, args.port)
+    else:
+        address = args.socket if args.socket is not None else DEFAULT_ADDRESS
+    token = read_token(args.token_file) if args.token_file is not None else None
+    serve(address, processes=args.processes, cache_dir=args.cache_dir, token=token)
+
+
+if __name__ == '__main__':
+    sys.exit(main())